@@ -3,63 +3,245 @@ import sqlite3
 import os
 import csv
 import json
+import re
+import sys
+import html
+import hmac
+import secrets
+import signal
 import asyncio
+import functools
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask
-from threading import Thread
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
     ReplyKeyboardMarkup, KeyboardButton
 )
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
-    CallbackQueryHandler, ContextTypes, filters
+    CallbackQueryHandler, ContextTypes, BaseRateLimiter, BaseUpdateProcessor, ExtBot, filters
 )
 from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
 from dotenv import load_dotenv
 
 load_dotenv()
 
-flask_app = Flask(__name__)
-
-@flask_app.route("/")
-def home():
-    return "Bot is alive ✅"
-
-@flask_app.route("/ping")
-def ping():
-    return "pong"
-
-def run_flask():
-    try:
-        flask_app.run(host="0.0.0.0", port=5000, use_reloader=False)
-    except OSError as e:
-        if "Address already in use" in str(e):
-            logging.warning("Port 5000 already in use, trying port 8080...")
-            flask_app.run(host="0.0.0.0", port=8080, use_reloader=False)
-        else:
-            raise
-
-Thread(target=run_flask, daemon=True).start()
-
-
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN environment variable not set! Please add your bot token to .env or Replit Secrets.")
 
+# Extra bot tokens for sharded broadcasts: every extra token gets its own worker process and
+# rate limit, the main token's shard is sent in-process through send_rate_limiter. file_ids are
+# per bot, so only text ads are sharded; users a helper bot can't reach go to the main bot.
+# Only set this if most users have also started every helper bot: a bot can't message anyone
+# who never started it, so otherwise nearly every helper send fails and the main bot re-sends
+# it afterwards, one by one - slower than no sharding and twice the API calls.
+BROADCAST_SHARD_TOKENS = [t.strip() for t in os.getenv("BROADCAST_SHARD_TOKENS", "").split(",") if t.strip()]
+# Bot API endpoint; point it at a local stand-in to drive the bot without Telegram
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+
+# Health/metrics HTTP server, also receives updates in webhook mode (WEBHOOK_URL set).
+# Without WEBHOOK_URL the bot keeps using long polling.
+HTTP_PORT = int(os.getenv("PORT", "5000"))
+HTTP_KEEPALIVE_TIMEOUT = 75
+HTTP_MAX_BODY = 1024 * 1024
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Without WEBHOOK_SECRET a random one is made per start; set_webhook hands it to Telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Updates handled at the same time across all users; each user's updates still run in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Minimum seconds between two scheduled channel posts; posts due together are spread out
+SCHEDULED_POST_GAP = int(os.getenv("SCHEDULED_POST_GAP", "60"))
+# Seconds background tasks get to checkpoint on shutdown before they are cancelled
+BACKGROUND_DRAIN_TIMEOUT = float(os.getenv("BACKGROUND_DRAIN_TIMEOUT", "25"))
+# /metrics needs "Authorization: Bearer <METRICS_TOKEN>"; it is off while METRICS_TOKEN is empty
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 CHANNEL_USERNAME = "@multklar_olami"
 MAIN_ADMIN_ID = 5663190258
 
+MEMBERSHIP_CACHE_POSITIVE_TTL = int(os.getenv("MEMBERSHIP_CACHE_POSITIVE_TTL", "300"))
+MEMBERSHIP_CACHE_NEGATIVE_TTL = int(os.getenv("MEMBERSHIP_CACHE_NEGATIVE_TTL", "30"))
+MEMBERSHIP_CACHE_MAX_SIZE = int(os.getenv("MEMBERSHIP_CACHE_MAX_SIZE", "50000"))
+FILM_CACHE_MAX_SIZE = int(os.getenv("FILM_CACHE_MAX_SIZE", "1000"))
+FILM_SEARCH_PAGE_SIZE = 10
+
+ACTIVITY_FLUSH_INTERVAL = int(os.getenv("ACTIVITY_FLUSH_INTERVAL", "10"))
+ACTIVITY_FLUSH_MAX_PENDING = int(os.getenv("ACTIVITY_FLUSH_MAX_PENDING", "500"))
+
+# Sends kept in flight during a broadcast, and how many finished recipients per checkpoint
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "200"))
+# "copy" re-sends the admin's original message via copy_message, "send" uploads the content
+# with send_photo/send_video/... for every recipient
+BROADCAST_MODE = os.getenv("BROADCAST_MODE", "copy")
+# Seconds between edits of the broadcast status message
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+
+# Shared token bucket for every outgoing message (Telegram allows ~30 msg/s per bot)
+TELEGRAM_SEND_RATE = float(os.getenv("TELEGRAM_SEND_RATE", "25"))
+TELEGRAM_SEND_BURST = float(os.getenv("TELEGRAM_SEND_BURST", "5"))
+TELEGRAM_SEND_MIN_RATE = float(os.getenv("TELEGRAM_SEND_MIN_RATE", "5"))
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "2"))
+
+MEMBERSHIP_CHECK_CONCURRENCY = int(os.getenv("MEMBERSHIP_CHECK_CONCURRENCY", "8"))
+MEMBERSHIP_CHECK_TIMEOUT = float(os.getenv("MEMBERSHIP_CHECK_TIMEOUT", "3"))
+# On timeout: "open" treats the channel as joined, "closed" asks the user to join it
+MEMBERSHIP_TIMEOUT_POLICY = os.getenv("MEMBERSHIP_TIMEOUT_POLICY", "open")
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-conn = sqlite3.connect("users.db", check_same_thread=False)
+DB_PATH = "users.db"
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "100"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+def _apply_pragmas(connection):
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    connection.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    connection.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+
+# Writer connection: used by startup code and afterwards only by the writer thread.
+# isolation_level=None because the writer thread manages transactions itself.
+conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
 conn.execute("PRAGMA journal_mode=WAL")
+_apply_pragmas(conn)
 c = conn.cursor()
 
+# Read-only WAL connections, one per reader pool thread
+_reader_local = threading.local()
+
+def _init_reader_connection():
+    reader = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    _apply_pragmas(reader)
+    _reader_local.conn = reader
+
+def _read_cursor():
+    # Outside the reader pool (startup, writer thread) fall back to the writer connection
+    reader = getattr(_reader_local, "conn", None)
+    return (reader or conn).cursor()
+
+_db_read_executor = ThreadPoolExecutor(
+    max_workers=DB_READ_POOL_SIZE, thread_name_prefix="db-read", initializer=_init_reader_connection
+)
+
+def db_read(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_db_read_executor, functools.partial(func, *args, **kwargs))
+    # Plain version for code that already runs on a DB thread (startup, other helpers)
+    wrapper.sync = func
+    return wrapper
+
+# Single writer: requests are queued and applied in batches, each request inside its own
+# SAVEPOINT, with one COMMIT per batch. Callers are resumed only after the commit.
+_write_queue = queue.Queue()
+_after_commit_callbacks = None
+
+def db_write(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        _write_queue.put((func, args, kwargs, loop, future))
+        return await future
+    wrapper.sync = func
+    return wrapper
+
+def _after_commit(func, *args):
+    # Cache invalidation etc. must not become visible before the data it describes
+    if _after_commit_callbacks is None or threading.current_thread() is not _writer_thread:
+        func(*args)
+    else:
+        _after_commit_callbacks.append((func, args))
+
+def _resolve_write(future, ok, value):
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+def _run_write_batch(batch):
+    global _after_commit_callbacks
+    results = []
+    callbacks = []
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for func, args, kwargs, _, _ in batch:
+            _after_commit_callbacks = []
+            conn.execute("SAVEPOINT db_write")
+            try:
+                result = func(*args, **kwargs)
+                conn.execute("RELEASE db_write")
+                callbacks.extend(_after_commit_callbacks)
+                results.append((True, result))
+            except Exception as e:
+                conn.execute("ROLLBACK TO db_write")
+                conn.execute("RELEASE db_write")
+                results.append((False, e))
+        conn.execute("COMMIT")
+    except Exception as e:
+        logging.error(f"DB yozishda xatolik: {e}")
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        results = [(False, e)] * len(batch)
+        callbacks = []
+    finally:
+        _after_commit_callbacks = None
+    for func, args in callbacks:
+        try:
+            func(*args)
+        except Exception as e:
+            logging.error(f"After-commit xatolik: {e}")
+    for (_, _, _, loop, future), (ok, value) in zip(batch, results):
+        loop.call_soon_threadsafe(_resolve_write, future, ok, value)
+
+def _writer_loop():
+    stopping = False
+    while not stopping:
+        item = _write_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        while len(batch) < DB_WRITE_BATCH_MAX:
+            try:
+                item = _write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        _run_write_batch(batch)
+
+_writer_thread = threading.Thread(target=_writer_loop, name="db-write", daemon=True)
+
+def start_db_writer():
+    if not _writer_thread.is_alive():
+        _writer_thread.start()
+
+def shutdown_db():
+    if _writer_thread.is_alive():
+        _write_queue.put(None)
+        _writer_thread.join()
+    _db_read_executor.shutdown(wait=True)
+
 c.execute("""
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
@@ -136,6 +318,125 @@ c.execute("""
     )
 """)
 
+c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT PRIMARY KEY,
+        joins INTEGER NOT NULL DEFAULT 0,
+        active_users INTEGER NOT NULL DEFAULT 0
+    )
+""")
+
+c.execute("""
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+""")
+
+# Broadcast campaigns: recipients are walked in user_id order and last_user_id is the
+# checkpoint, so a restarted campaign continues after the last finished batch.
+c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        buttons TEXT,
+        status TEXT NOT NULL DEFAULT 'running',
+        total INTEGER NOT NULL DEFAULT 0,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        skipped_blocked INTEGER NOT NULL DEFAULT 0,
+        skipped_unreachable INTEGER NOT NULL DEFAULT 0,
+        status_chat_id INTEGER,
+        status_message_id INTEGER,
+        created_at TEXT,
+        updated_at TEXT,
+        finished_at TEXT
+    )
+""")
+
+# Only recipients that were not delivered get a row ('failed' or 'unreachable')
+c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        campaign_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        PRIMARY KEY (campaign_id, user_id)
+    ) WITHOUT ROWID
+""")
+
+# Sharded campaigns: each shard owns the user_id range (lo_user_id, hi_user_id] and is sent by
+# its own process, which checkpoints here. status is 'running', 'stop' (requested) or 'done'.
+c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_shards (
+        campaign_id INTEGER NOT NULL,
+        shard INTEGER NOT NULL,
+        lo_user_id INTEGER NOT NULL,
+        hi_user_id INTEGER NOT NULL,
+        last_user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        skipped_blocked INTEGER NOT NULL DEFAULT 0,
+        skipped_unreachable INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT,
+        PRIMARY KEY (campaign_id, shard)
+    )
+""")
+
+# Segmented campaigns copy their audience here once, so the send loop can always page
+# through (campaign_id, user_id) in order no matter which filters built the segment
+c.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_audience (
+        campaign_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (campaign_id, user_id)
+    ) WITHOUT ROWID
+""")
+
+# Delayed channel posts; status is 'pending', 'sent', 'failed' or 'cancelled'
+c.execute("""
+    CREATE TABLE IF NOT EXISTS scheduled_posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER NOT NULL,
+        target_channel TEXT,
+        file_type TEXT,
+        file_id TEXT,
+        caption TEXT,
+        btn_text TEXT,
+        code TEXT NOT NULL,
+        due_at TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        created_at TEXT,
+        sent_at TEXT
+    )
+""")
+
+c.execute("""
+    CREATE TABLE IF NOT EXISTS film_requests (
+        film_code TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        last_requested TEXT,
+        PRIMARY KEY (film_code, user_id)
+    ) WITHOUT ROWID
+""")
+
+# Per-user delivery health, updated in bulk from broadcast checkpoints. reachable = 0 means
+# Telegram refused the chat (bot blocked, account deleted); error_count counts consecutive
+# errors and is reset by a successful send.
+c.execute("""
+    CREATE TABLE IF NOT EXISTS user_deliverability (
+        user_id INTEGER PRIMARY KEY,
+        reachable INTEGER NOT NULL DEFAULT 1,
+        last_error TEXT,
+        last_error_at TEXT,
+        last_success TEXT,
+        error_count INTEGER NOT NULL DEFAULT 0
+    )
+""")
+
 def migrate_db():
     # Check for display_name in channels
     try:
@@ -168,6 +469,184 @@ def migrate_db():
             logging.error(f"Migration error (channels invite_link): {e}")
     
     conn.commit()
+    run_schema_migrations()
+
+def _strip_html(text):
+    return " ".join(html.unescape(re.sub(r"<[^>]+>", " ", text or "")).split())
+
+def _index_film(film_id, code, caption):
+    c.execute("INSERT OR REPLACE INTO films_fts (rowid, code, caption) VALUES (?, ?, ?)",
+              (film_id, code, _strip_html(caption)))
+
+def _backfill_film_search_index():
+    c.execute("DELETE FROM films_fts")
+    rows = conn.execute("SELECT id, code, caption FROM films")
+    while True:
+        batch = rows.fetchmany(1000)
+        if not batch:
+            break
+        c.executemany("INSERT INTO films_fts (rowid, code, caption) VALUES (?, ?, ?)",
+                      [(film_id, code, _strip_html(caption)) for film_id, code, caption in batch])
+
+def _migrate_last_ad_states():
+    # Pending retry sets from the old last_ad_state_<admin_id> blobs become finished campaigns
+    # whose failed users sit in broadcast_recipients, so the retry button still reaches them
+    rows = conn.execute("SELECT key, value FROM bot_settings WHERE key LIKE 'last\\_ad\\_state\\_%' ESCAPE '\\'").fetchall()
+    for key, value in rows:
+        try:
+            state = json.loads(value) if value else None
+            admin_id = int(key.rsplit("_", 1)[1])
+            failed = sorted({int(uid) for uid in state.get("failed") or []}) if state else []
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.warning(f"{key}: o'qib bo'lmadi, o'chirildi ({e})")
+            continue
+        if not failed:
+            continue
+        created = state.get("timestamp") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        c.execute("""
+            INSERT INTO broadcast_campaigns
+                (admin_id, payload, buttons, status, total, failed, created_at, updated_at, finished_at)
+            VALUES (?, ?, ?, 'done', ?, ?, ?, ?, ?)
+        """, (admin_id, json.dumps(state.get("payload") or {}), json.dumps(state.get("buttons") or []),
+              len(failed), len(failed), created, created, created))
+        campaign_id = c.lastrowid
+        c.executemany("INSERT INTO broadcast_recipients (campaign_id, user_id, status) VALUES (?, ?, 'failed')",
+                      [(campaign_id, uid) for uid in failed])
+        logging.info(f"{key}: {len(failed)} ta yuborilmagan user kampaniya #{campaign_id} ga ko'chirildi")
+
+# Versioned migrations tracked in PRAGMA user_version. Each entry runs once, in a single
+# transaction; a step is either an SQL string or a callable taking no arguments.
+SCHEMA_MIGRATIONS = [
+    (1, "film_parts, users va blocked_users indekslari", [
+        # Keep the newest upload of duplicated parts before enforcing uniqueness
+        "DELETE FROM film_parts WHERE id NOT IN (SELECT MAX(id) FROM film_parts GROUP BY film_code, part_number)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_film_parts_code_part ON film_parts (film_code, part_number)",
+        "CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)",
+        "CREATE INDEX IF NOT EXISTS idx_blocked_users_blocked_date ON blocked_users (blocked_date)",
+    ]),
+    (2, "daily_stats rollup va triggerlar", [
+        "DELETE FROM daily_stats",
+        """
+        INSERT INTO daily_stats (day, joins, active_users)
+        SELECT substr(join_date, 1, 10), COUNT(*), 0 FROM users
+        WHERE join_date IS NOT NULL GROUP BY substr(join_date, 1, 10)
+        """,
+        # Only the latest active day of each user is known for historical rows
+        """
+        INSERT INTO daily_stats (day, joins, active_users)
+        SELECT substr(last_active, 1, 10), 0, COUNT(*) FROM users
+        WHERE last_active IS NOT NULL GROUP BY substr(last_active, 1, 10)
+        ON CONFLICT(day) DO UPDATE SET active_users = excluded.active_users
+        """,
+        """
+        INSERT INTO stats_counters (key, value) SELECT 'users_total', COUNT(*) FROM users WHERE 1
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert_stats AFTER INSERT ON users
+        BEGIN
+            INSERT INTO daily_stats (day, joins, active_users) VALUES (substr(NEW.join_date, 1, 10), 1, 0)
+                ON CONFLICT(day) DO UPDATE SET joins = joins + 1;
+            INSERT INTO daily_stats (day, joins, active_users) VALUES (substr(NEW.last_active, 1, 10), 0, 1)
+                ON CONFLICT(day) DO UPDATE SET active_users = active_users + 1;
+            UPDATE stats_counters SET value = value + 1 WHERE key = 'users_total';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_active_stats AFTER UPDATE OF last_active ON users
+        WHEN NEW.last_active IS NOT NULL
+            AND substr(NEW.last_active, 1, 10) IS NOT substr(OLD.last_active, 1, 10)
+        BEGIN
+            INSERT INTO daily_stats (day, joins, active_users) VALUES (substr(NEW.last_active, 1, 10), 0, 1)
+                ON CONFLICT(day) DO UPDATE SET active_users = active_users + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete_stats AFTER DELETE ON users
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE key = 'users_total';
+        END
+        """,
+    ]),
+    (3, "films_fts qidiruv indeksi", [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS films_fts USING fts5(code, caption, tokenize='unicode61 remove_diacritics 2')",
+        _backfill_film_search_index,
+    ]),
+    (4, "user_deliverability indeksi", [
+        "CREATE INDEX IF NOT EXISTS idx_user_deliverability_unreachable ON user_deliverability (user_id) WHERE reachable = 0",
+    ]),
+    (5, "broadcast_campaigns.segment", [
+        "ALTER TABLE broadcast_campaigns ADD COLUMN segment TEXT",
+    ]),
+    # Retry sets now live in broadcast_recipients; move pending ones over, then drop the old JSON blobs
+    (6, "last_ad_state bot_settings yozuvlarini ko'chirish", [
+        _migrate_last_ad_states,
+        "DELETE FROM bot_settings WHERE key LIKE 'last\\_ad\\_state\\_%' ESCAPE '\\'",
+    ]),
+    (7, "scheduled_posts indeksi", [
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_pending ON scheduled_posts(due_at) WHERE status = 'pending'",
+    ]),
+    # Unreachable users counted like users_total, so statistics read one row instead of the index
+    (8, "stats_counters.unreachable", [
+        """
+        INSERT INTO stats_counters (key, value)
+        SELECT 'unreachable', COUNT(*) FROM user_deliverability WHERE reachable = 0
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_deliverability_insert_stats AFTER INSERT ON user_deliverability
+        WHEN NEW.reachable = 0
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE key = 'unreachable';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_deliverability_update_stats AFTER UPDATE OF reachable ON user_deliverability
+        WHEN NEW.reachable IS NOT OLD.reachable
+        BEGIN
+            UPDATE stats_counters SET value = value + CASE WHEN NEW.reachable = 0 THEN 1 ELSE -1 END
+            WHERE key = 'unreachable';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_deliverability_delete_stats AFTER DELETE ON user_deliverability
+        WHEN OLD.reachable = 0
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE key = 'unreachable';
+        END
+        """,
+    ]),    # Pid of the worker process sending a helper shard, so a restart never starts a second one
+    (9, "broadcast_shards.worker_pid", [
+        "ALTER TABLE broadcast_shards ADD COLUMN worker_pid INTEGER",
+    ]),
+]
+
+def get_schema_version():
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_schema_migrations():
+    current = get_schema_version()
+    for version, description, steps in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info(f"Schema migration {version}: {description}")
+        started = time.monotonic()
+        try:
+            conn.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    step()
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Schema migration {version} xatolik: {e}")
+            raise
+        logging.info(f"Schema migration {version} tugadi ({time.monotonic() - started:.1f}s)")
+        current = version
 
 migrate_db()
 
@@ -179,40 +658,168 @@ c.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)",
           ("about_text", "ℹ️ <b>Bot haqida</b>\n\n<b>Name: Multifilm kodlari</b>\n<b>About: ✉️ Film kodini yuboring</b>\n\nVa sevimli filmlaringizni yuqori sifatda tomosha qiling‼️\n\n⚠️Botdan foydalanish tez va oson❗️\n\n🔎Instagram: https://www.instagram.com/premyera_multifilmlar?igsh=MTBqdTNpaHI1YWJ6bQ==\n\n‼️Bot ishlamasa adminga murojat qiling✅️\n🧑‍💻 @JavohirJalilovv"))
 conn.commit()
 
+@db_write
 def log_admin_action(admin_id, action, details=""):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     c.execute("INSERT INTO admin_logs (admin_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
               (admin_id, action, details, now))
-    conn.commit()
 
-def save_user(user_id):
+# user_id -> [first_seen, last_seen] waiting to be written by flush_user_activity()
+_pending_activity = {}
+
+async def save_user(user_id):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("""
+    entry = _pending_activity.get(user_id)
+    if entry:
+        entry[1] = now
+    else:
+        _pending_activity[user_id] = [now, now]
+    if len(_pending_activity) >= ACTIVITY_FLUSH_MAX_PENDING:
+        await flush_user_activity()
+
+@db_write
+def _write_user_activity(rows):
+    c.executemany("""
         INSERT INTO users (user_id, join_date, last_active)
         VALUES (?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET last_active=?
-    """, (user_id, now, now, now))
-    conn.commit()
+        ON CONFLICT(user_id) DO UPDATE SET last_active=excluded.last_active
+    """, rows)
+    # Anyone who talks to the bot again has unblocked it
+    c.executemany("UPDATE user_deliverability SET reachable = 1, error_count = 0 WHERE user_id = ? AND reachable = 0",
+                  [(row[0],) for row in rows])
+
+@db_write
+def _write_film_requests(rows):
+    c.executemany("""
+        INSERT INTO film_requests (film_code, user_id, last_requested) VALUES (?, ?, ?)
+        ON CONFLICT(film_code, user_id) DO UPDATE SET last_requested = excluded.last_requested
+    """, rows)
+
+# (film_code, user_id) -> last request time, flushed together with user activity
+_pending_film_requests = {}
+
+def note_film_request(user_id, code):
+    _pending_film_requests[(code, user_id)] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+async def flush_film_requests():
+    if not _pending_film_requests:
+        return
+    rows = [(code, uid, requested) for (code, uid), requested in _pending_film_requests.items()]
+    _pending_film_requests.clear()
+    try:
+        await _write_film_requests(rows)
+    except Exception as e:
+        logging.error(f"Film so'rovlarini saqlashda xatolik: {e}")
+        for code, uid, requested in rows:
+            _pending_film_requests.setdefault((code, uid), requested)
+
+async def flush_user_activity():
+    await flush_film_requests()
+    if not _pending_activity:
+        return 0
+    rows = [(uid, first_seen, last_seen) for uid, (first_seen, last_seen) in _pending_activity.items()]
+    _pending_activity.clear()
+    try:
+        await _write_user_activity(rows)
+    except Exception as e:
+        logging.error(f"User faolligini saqlashda xatolik: {e}")
+        # Put the rows back so the next flush retries them, keeping any newer activity
+        for uid, first_seen, last_seen in rows:
+            entry = _pending_activity.get(uid)
+            if entry:
+                entry[0] = first_seen
+            else:
+                _pending_activity[uid] = [first_seen, last_seen]
+        return 0
+    return len(rows)
+
+_activity_flusher_stop = None
+
+def start_activity_flusher():
+    global _activity_flusher_stop
+    _activity_flusher_stop = asyncio.Event()
+    start_background_task(("flusher", "activity"), run_activity_flusher())
+
+def stop_activity_flusher():
+    if _activity_flusher_stop:
+        _activity_flusher_stop.set()
+
+async def run_activity_flusher():
+    # Writes buffered activity every ACTIVITY_FLUSH_INTERVAL seconds; on_shutdown does the last flush
+    while not _activity_flusher_stop.is_set():
+        try:
+            await asyncio.wait_for(_activity_flusher_stop.wait(), ACTIVITY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            await flush_user_activity()
 
 def is_admin(user_id):
-    c.execute("SELECT user_id FROM admins WHERE user_id = ?", (user_id,))
-    return c.fetchone() is not None
+    return user_id in _admin_ids
 
 def is_blocked(user_id):
-    c.execute("SELECT user_id FROM blocked_users WHERE user_id = ?", (user_id,))
-    return c.fetchone() is not None
-
-def get_all_users():
-    c.execute("SELECT user_id FROM users")
-    return [row[0] for row in c.fetchall()]
+    return user_id in _blocked_ids
 
+@db_read
 def get_all_admins():
-    c.execute("SELECT user_id FROM admins")
-    return [row[0] for row in c.fetchall()]
+    cur = _read_cursor()
+    cur.execute("SELECT user_id FROM admins")
+    return [row[0] for row in cur.fetchall()]
 
+@db_read
 def get_all_channels():
-    c.execute("SELECT channel_username, channel_type, display_name, invite_link FROM channels")
-    return c.fetchall()
+    cur = _read_cursor()
+    cur.execute("SELECT channel_username, channel_type, display_name, invite_link FROM channels")
+    return cur.fetchall()
+
+@db_write
+def update_channel_invite_link(channel_username, invite_link):
+    c.execute("UPDATE channels SET invite_link = ? WHERE channel_username = ?", (invite_link, channel_username))
+
+@db_write
+def rename_channel(channel_username, display_name):
+    c.execute("UPDATE channels SET display_name = ? WHERE channel_username = ?", (display_name, channel_username))
+
+@db_write
+def add_channel(channel_username, channel_type, added_by, display_name, invite_link):
+    c.execute("INSERT INTO channels (channel_username, channel_type, added_by, added_date, display_name, invite_link) VALUES (?, ?, ?, ?, ?, ?)",
+              (channel_username, channel_type, added_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), display_name, invite_link))
+
+@db_write
+def delete_channel(channel_username):
+    c.execute("DELETE FROM channels WHERE channel_username = ?", (channel_username,))
+
+@db_write
+def add_admin(user_id, added_by):
+    c.execute("INSERT OR IGNORE INTO admins (user_id, added_by, added_date) VALUES (?, ?, ?)",
+              (user_id, added_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    _after_commit(refresh_auth_snapshot.sync)
+
+@db_write
+def remove_admin(user_id):
+    c.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+    _after_commit(refresh_auth_snapshot.sync)
+
+@db_write
+def block_user(user_id, blocked_by):
+    c.execute("INSERT INTO blocked_users (user_id, blocked_by, blocked_date) VALUES (?, ?, ?)",
+              (user_id, blocked_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    _after_commit(refresh_auth_snapshot.sync)
+
+@db_write
+def unblock_user(user_id):
+    c.execute("DELETE FROM blocked_users WHERE user_id = ?", (user_id,))
+    _after_commit(refresh_auth_snapshot.sync)
+
+@db_read
+def get_admin_logs(limit=1000):
+    cur = _read_cursor()
+    cur.execute("SELECT * FROM admin_logs ORDER BY id DESC LIMIT ?", (limit,))
+    return cur.fetchall()
+
+@db_read
+def get_blocked_users():
+    cur = _read_cursor()
+    cur.execute("SELECT user_id, blocked_by, blocked_date, reason FROM blocked_users ORDER BY blocked_date DESC")
+    return cur.fetchall()
 
 def _serialize_buttons(buttons):
     if not buttons:
@@ -237,213 +844,1172 @@ def _build_markup_from_serialized(serialized):
         kb.append(kb_row)
     return InlineKeyboardMarkup(kb)
 
-def save_last_ad_state(admin_id, payload, failed_list, buttons_serialized):
-    state = {
-        "payload": payload,
-        "failed": failed_list,
-        "buttons": buttons_serialized,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# Endpoints that deliver a message to a chat and count towards Telegram's send limits
+RATE_LIMITED_ENDPOINTS = frozenset({
+    "sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendAudio", "sendVoice",
+    "sendAnimation", "sendVideoNote", "sendSticker", "sendMediaGroup",
+    "copyMessage", "copyMessages", "forwardMessage", "forwardMessages",
+})
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    # Plugged into the bot, so broadcasts, film delivery and channel posts all share one bucket.
+    # RetryAfter pauses every sender at once and lowers the rate; each success raises it a
+    # little until it is back at max_rate.
+    def __init__(self, max_rate, burst, min_rate, max_retries):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.burst = max(burst, 1)
+        self.max_retries = max_retries
+        self.retry_after_count = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = None
+
+    async def initialize(self):
+        self._lock = asyncio.Lock()
+
+    async def shutdown(self):
+        pass
+
+    async def _acquire(self):
+        # Waiters queue on the lock, so tokens are handed out in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def _on_retry_after(self, retry_after):
+        self.retry_after_count += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._tokens = 0
+        self._updated = self._paused_until
+        self.rate = max(self.min_rate, self.rate * 0.7)
+        logging.warning(f"Telegram RetryAfter {retry_after}s: yuborish to'xtatildi, tezlik {self.rate:.1f} msg/s")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint in RATE_LIMITED_ENDPOINTS
+        attempt = 0
+        while True:
+            if limited:
+                await self._acquire()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._on_retry_after(float(e.retry_after) + 0.1)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                if not limited:
+                    await asyncio.sleep(max(0.0, self._paused_until - time.monotonic()))
+                continue
+            if limited and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.05)
+            return result
+
+send_rate_limiter = TokenBucketRateLimiter(
+    TELEGRAM_SEND_RATE, TELEGRAM_SEND_BURST, TELEGRAM_SEND_MIN_RATE, TELEGRAM_SEND_MAX_RETRIES
+)
+
+# Broadcast audience: users that are neither blocked nor known to be unreachable. The
+# anti-joins run inside SQLite, so recipients are streamed page by page and skipped ids
+# never reach Python.
+BROADCAST_AUDIENCE_SQL = (
+    "FROM users u WHERE NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = u.user_id)"
+    " AND NOT EXISTS (SELECT 1 FROM user_deliverability d WHERE d.user_id = u.user_id AND d.reachable = 0)"
+)
+
+def _count_broadcast_audience(cur):
+    cur.execute(f"SELECT COUNT(*) {BROADCAST_AUDIENCE_SQL}")
+    recipients = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM blocked_users b WHERE EXISTS (SELECT 1 FROM users u WHERE u.user_id = b.user_id)")
+    return recipients, cur.fetchone()[0]
+
+def build_audience_query(segment):
+    # segment keys (all optional, combined with AND):
+    #   active_days    - last_active within N days       (idx_users_last_active)
+    #   joined_from/to - join date range, YYYY-MM-DD      (idx_users_join_date)
+    #   film_code      - users who requested this code    (film_requests primary key)
+    # sample_percent is applied when the audience is materialized, see create_broadcast_campaign
+    sql = BROADCAST_AUDIENCE_SQL
+    params = []
+    if segment.get("active_days"):
+        sql += " AND u.last_active >= ?"
+        params.append((datetime.now() - timedelta(days=int(segment["active_days"]))).strftime("%Y-%m-%d %H:%M:%S"))
+    if segment.get("joined_from"):
+        sql += " AND u.join_date >= ?"
+        params.append(segment["joined_from"])
+    if segment.get("joined_to"):
+        sql += " AND u.join_date < ?"
+        params.append((datetime.strptime(segment["joined_to"], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d"))
+    if segment.get("film_code"):
+        sql += " AND u.user_id IN (SELECT user_id FROM film_requests WHERE film_code = ?)"
+        params.append(segment["film_code"])
+    return sql, params
+
+def describe_segment(segment):
+    if not segment:
+        return "Hammaga"
+    parts = []
+    if segment.get("active_days"):
+        parts.append(f"oxirgi {segment['active_days']} kunda faol")
+    if segment.get("joined_from") or segment.get("joined_to"):
+        parts.append(f"qo'shilgan: {segment.get('joined_from', '...')} — {segment.get('joined_to', '...')}")
+    if segment.get("film_code"):
+        parts.append(f"<code>{html.escape(segment['film_code'])}</code> kodini so'raganlar")
+    if segment.get("sample_percent"):
+        parts.append(f"tasodifiy {segment['sample_percent']}%")
+    return ", ".join(parts)
+
+def _count_segment(cur, segment):
+    sql, params = build_audience_query(segment)
+    cur.execute(f"SELECT COUNT(*) {sql}", params)
+    count = cur.fetchone()[0]
+    if segment.get("sample_percent"):
+        count = (count * int(segment["sample_percent"]) + 99) // 100
+    return count
+
+@db_read
+def count_broadcast_audience(segment=None):
+    if segment:
+        return _count_segment(_read_cursor(), segment)
+    return _count_broadcast_audience(_read_cursor())[0]
+
+@db_write
+def create_broadcast_campaign(admin_id, payload, buttons_serialized, status_chat_id, status_message_id, segment=None):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    recipients, blocked = (0, 0) if segment else _count_broadcast_audience(c)
+    c.execute("""
+        INSERT INTO broadcast_campaigns
+            (admin_id, payload, buttons, status, total, skipped_blocked, status_chat_id, status_message_id,
+             created_at, updated_at, segment)
+        VALUES (?, ?, ?, 'running', ?, ?, ?, ?, ?, ?, ?)
+    """, (admin_id, json.dumps(payload), json.dumps(buttons_serialized), recipients + blocked, blocked,
+          status_chat_id, status_message_id, now, now, json.dumps(segment) if segment else None))
+    campaign_id = c.lastrowid
+    if segment:
+        sql, params = build_audience_query(segment)
+        if segment.get("sample_percent"):
+            # Random sample; the chosen ids stay in broadcast_audience as the A/B group record
+            c.execute(f"""
+                INSERT INTO broadcast_audience (campaign_id, user_id)
+                SELECT ?, user_id FROM (SELECT u.user_id {sql} ORDER BY random()
+                                        LIMIT (SELECT (COUNT(*) * ? + 99) / 100 {sql}))
+            """, [campaign_id] + params + [int(segment["sample_percent"])] + params)
+        else:
+            c.execute(f"INSERT INTO broadcast_audience (campaign_id, user_id) SELECT ?, u.user_id {sql}",
+                      [campaign_id] + params)
+        c.execute("UPDATE broadcast_campaigns SET total = ? WHERE id = ?", (c.rowcount, campaign_id))
+    return campaign_id
+
+@db_read
+def get_broadcast_campaign(campaign_id):
+    cur = _read_cursor()
+    cur.execute("""
+        SELECT id, admin_id, payload, buttons, status, total, last_user_id, sent, failed,
+               skipped_blocked, skipped_unreachable, status_chat_id, status_message_id, segment,
+               (SELECT COUNT(*) FROM broadcast_shards s WHERE s.campaign_id = broadcast_campaigns.id)
+        FROM broadcast_campaigns WHERE id = ?
+    """, (campaign_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    campaign = dict(zip((
+        "id", "admin_id", "payload", "buttons", "status", "total", "last_user_id", "sent", "failed",
+        "skipped_blocked", "skipped_unreachable", "status_chat_id", "status_message_id", "segment", "shards"
+    ), row))
+    campaign["payload"] = json.loads(campaign["payload"])
+    campaign["buttons"] = json.loads(campaign["buttons"] or "[]")
+    campaign["segment"] = json.loads(campaign["segment"]) if campaign["segment"] else None
+    return campaign
+
+@db_read
+def get_latest_retry_campaign_id(admin_id):
+    cur = _read_cursor()
+    cur.execute("SELECT MAX(id) FROM broadcast_campaigns WHERE admin_id = ? AND failed > 0", (admin_id,))
+    return cur.fetchone()[0]
+
+@db_read
+def get_running_campaign_ids():
+    cur = _read_cursor()
+    cur.execute("SELECT id FROM broadcast_campaigns WHERE status = 'running' ORDER BY id")
+    return [row[0] for row in cur.fetchall()]
+
+@db_read
+def get_broadcast_recipients_page(after_user_id, limit, campaign_id=None, upto_user_id=2 ** 63 - 1):
+    cur = _read_cursor()
+    if campaign_id is None:
+        cur.execute(f"""
+            SELECT u.user_id {BROADCAST_AUDIENCE_SQL} AND u.user_id > ? AND u.user_id <= ?
+            ORDER BY u.user_id LIMIT ?
+        """, (after_user_id, upto_user_id, limit))
+    else:
+        # Segment snapshot; blocked and unreachable users are still re-checked at send time
+        cur.execute("""
+            SELECT a.user_id FROM broadcast_audience a
+            WHERE a.campaign_id = ? AND a.user_id > ? AND a.user_id <= ?
+              AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = a.user_id)
+              AND NOT EXISTS (SELECT 1 FROM user_deliverability d WHERE d.user_id = a.user_id AND d.reachable = 0)
+            ORDER BY a.user_id LIMIT ?
+        """, (campaign_id, after_user_id, upto_user_id, limit))
+    return [row[0] for row in cur.fetchall()]
+
+@db_read
+def get_campaign_failed_page(campaign_id, after_user_id, limit):
+    cur = _read_cursor()
+    cur.execute("""
+        SELECT user_id FROM broadcast_recipients
+        WHERE campaign_id = ? AND status = 'failed' AND user_id > ?
+        ORDER BY user_id LIMIT ?
+    """, (campaign_id, after_user_id, limit))
+    return [row[0] for row in cur.fetchall()]
+
+def _record_deliverability(results):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.executemany("""
+        INSERT INTO user_deliverability (user_id, reachable, last_success, error_count) VALUES (?, 1, ?, 0)
+        ON CONFLICT(user_id) DO UPDATE SET reachable = 1, last_success = excluded.last_success, error_count = 0
+    """, [(uid, now) for uid, status, _ in results if status == "success"])
+    c.executemany("""
+        INSERT INTO user_deliverability (user_id, reachable, last_error, last_error_at, error_count)
+        VALUES (?, ?, ?, ?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET
+            reachable = CASE WHEN excluded.reachable = 0 THEN 0 ELSE reachable END,
+            last_error = excluded.last_error, last_error_at = excluded.last_error_at,
+            error_count = error_count + 1
+    """, [(uid, 0 if status == "skipped" else 1, (error or "")[:200], now)
+          for uid, status, error in results if status in ("skipped", "failed")])
+
+def _record_campaign_results(campaign_id, results, deliverability=True):
+    counts = {"success": 0, "failed": 0, "skipped": 0, "blocked": 0}
+    for _, status, _ in results:
+        counts[status] += 1
+    c.executemany("INSERT OR REPLACE INTO broadcast_recipients (campaign_id, user_id, status) VALUES (?, ?, ?)",
+                  [(campaign_id, uid, "unreachable" if status == "skipped" else "failed")
+                   for uid, status, _ in results if status in ("skipped", "failed")])
+    if deliverability:
+        _record_deliverability(results)
+    return counts
+
+@db_write
+def checkpoint_broadcast_campaign(campaign_id, last_user_id, results):
+    # Batch outcomes and the cursor move together, so a restart never skips or recounts a batch
+    counts = _record_campaign_results(campaign_id, results)
+    c.execute("""
+        UPDATE broadcast_campaigns
+        SET last_user_id = ?, sent = sent + ?, failed = failed + ?, skipped_blocked = skipped_blocked + ?,
+            skipped_unreachable = skipped_unreachable + ?, updated_at = ?
+        WHERE id = ?
+    """, (last_user_id, counts["success"], counts["failed"], counts["blocked"], counts["skipped"],
+          datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id))
+
+def _checkpoint_broadcast_retry(campaign_id, results):
+    # Retry round over the campaign's failed rows: delivered and blocked users leave the retry set,
+    # unreachable ones are re-labelled, and the campaign counters move with them
+    counts = {"success": 0, "failed": 0, "skipped": 0, "blocked": 0}
+    for _, status, _ in results:
+        counts[status] += 1
+    c.executemany("DELETE FROM broadcast_recipients WHERE campaign_id = ? AND user_id = ?",
+                  [(campaign_id, uid) for uid, status, _ in results if status in ("success", "blocked")])
+    c.executemany("UPDATE broadcast_recipients SET status = 'unreachable' WHERE campaign_id = ? AND user_id = ?",
+                  [(campaign_id, uid) for uid, status, _ in results if status == "skipped"])
+    _record_deliverability(results)
+    c.execute("""
+        UPDATE broadcast_campaigns
+        SET sent = sent + ?, failed = failed - ?, skipped_blocked = skipped_blocked + ?,
+            skipped_unreachable = skipped_unreachable + ?, updated_at = ?
+        WHERE id = ?
+    """, (counts["success"], counts["success"] + counts["blocked"] + counts["skipped"], counts["blocked"],
+          counts["skipped"], datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id))
+
+@db_write
+def checkpoint_broadcast_retry(campaign_id, results):
+    _checkpoint_broadcast_retry(campaign_id, results)
+
+@db_write
+def checkpoint_broadcast_handoff(campaign_id, results):
+    # Main-bot pass over the helper shards' failed rows. The owning shard's counters move too,
+    # so merge_broadcast_shards gives the same totals however often it runs.
+    _checkpoint_broadcast_retry(campaign_id, results)
+    c.executemany("""
+        UPDATE broadcast_shards
+        SET sent = sent + ?, failed = failed - 1, skipped_blocked = skipped_blocked + ?,
+            skipped_unreachable = skipped_unreachable + ?
+        WHERE campaign_id = ? AND lo_user_id < ? AND hi_user_id >= ?
+    """, [(status == "success", status == "blocked", status == "skipped", campaign_id, uid, uid)
+          for uid, status, _ in results if status != "failed"])
+
+@db_write
+def create_broadcast_shards(campaign_id, count):
+    # Split the audience into count id ranges of about the same size
+    c.execute("SELECT segment, skipped_blocked FROM broadcast_campaigns WHERE id = ?", (campaign_id,))
+    segment, blocked = c.fetchone()
+    if segment:
+        ids_sql, params = "SELECT user_id FROM broadcast_audience WHERE campaign_id = ? ORDER BY user_id", [campaign_id]
+    else:
+        ids_sql, params = f"SELECT u.user_id {BROADCAST_AUDIENCE_SQL} ORDER BY u.user_id", []
+    c.execute(f"SELECT COUNT(*) FROM ({ids_sql})", params)
+    total = c.fetchone()[0]
+    bounds = [0]
+    for k in range(1, count):
+        c.execute(f"{ids_sql} LIMIT 1 OFFSET ?", params + [max(0, total * k // count - 1)])
+        row = c.fetchone()
+        bounds.append(max(bounds[-1], row[0] if row else bounds[-1]))
+    bounds.append(2 ** 63 - 1)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Blocked users counted at creation go to shard 0 so the campaign totals are plain sums
+    c.executemany("""
+        INSERT INTO broadcast_shards (campaign_id, shard, lo_user_id, hi_user_id, last_user_id, skipped_blocked, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(campaign_id, k, bounds[k], bounds[k + 1], bounds[k], blocked if k == 0 else 0, now) for k in range(count)])
+
+@db_read
+def get_broadcast_shards(campaign_id):
+    cur = _read_cursor()
+    cur.execute("""
+        SELECT shard, lo_user_id, hi_user_id, last_user_id, status, sent, failed, skipped_blocked, skipped_unreachable,
+               worker_pid
+        FROM broadcast_shards WHERE campaign_id = ? ORDER BY shard
+    """, (campaign_id,))
+    keys = ("shard", "lo_user_id", "hi_user_id", "last_user_id", "status", "sent", "failed",
+            "skipped_blocked", "skipped_unreachable", "worker_pid")
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+@db_write
+def set_broadcast_shards_status(campaign_id, status):
+    c.execute("UPDATE broadcast_shards SET status = ?, updated_at = ? WHERE campaign_id = ? AND status != 'done'",
+              (status, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id))
+
+@db_write
+def set_broadcast_shard_worker(campaign_id, shard, pid):
+    c.execute("UPDATE broadcast_shards SET worker_pid = ? WHERE campaign_id = ? AND shard = ?", (pid, campaign_id, shard))
+
+@db_write
+def checkpoint_broadcast_shard(campaign_id, shard, last_user_id, results, deliverability):
+    counts = _record_campaign_results(campaign_id, results, deliverability)
+    c.execute("""
+        UPDATE broadcast_shards
+        SET last_user_id = ?, sent = sent + ?, failed = failed + ?, skipped_blocked = skipped_blocked + ?,
+            skipped_unreachable = skipped_unreachable + ?, updated_at = ?
+        WHERE campaign_id = ? AND shard = ?
+    """, (last_user_id, counts["success"], counts["failed"], counts["blocked"], counts["skipped"],
+          datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id, shard))
+    # The coordinator asks shards to stop through this row
+    c.execute("SELECT status FROM broadcast_shards WHERE campaign_id = ? AND shard = ?", (campaign_id, shard))
+    return c.fetchone()[0]
+
+@db_write
+def finish_broadcast_shard(campaign_id, shard):
+    c.execute("UPDATE broadcast_shards SET status = 'done', updated_at = ? WHERE campaign_id = ? AND shard = ?",
+              (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id, shard))
+
+@db_write
+def merge_broadcast_shards(campaign_id):
+    c.execute("""
+        UPDATE broadcast_campaigns SET
+            sent = (SELECT SUM(sent) FROM broadcast_shards WHERE campaign_id = ?),
+            failed = (SELECT SUM(failed) FROM broadcast_shards WHERE campaign_id = ?),
+            skipped_blocked = (SELECT SUM(skipped_blocked) FROM broadcast_shards WHERE campaign_id = ?),
+            skipped_unreachable = (SELECT SUM(skipped_unreachable) FROM broadcast_shards WHERE campaign_id = ?),
+            updated_at = ?
+        WHERE id = ?
+    """, (campaign_id, campaign_id, campaign_id, campaign_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), campaign_id))
+
+@db_write
+def set_broadcast_campaign_status(campaign_id, status):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    finished_at = now if status in ("done", "cancelled") else None
+    c.execute("UPDATE broadcast_campaigns SET status = ?, updated_at = ?, finished_at = ? WHERE id = ?",
+              (status, now, finished_at, campaign_id))
+    if finished_at:
+        # Keep random samples as the record of who was in which A/B group
+        c.execute("""
+            DELETE FROM broadcast_audience WHERE campaign_id = ? AND EXISTS (
+                SELECT 1 FROM broadcast_campaigns
+                WHERE id = ? AND (segment IS NULL OR json_extract(segment, '$.sample_percent') IS NULL)
+            )
+        """, (campaign_id, campaign_id))
+
+SCHEDULED_POST_FIELDS = ("id", "admin_id", "target_channel", "file_type", "file_id", "caption", "btn_text", "code",
+                         "due_at", "status")
+
+def _free_post_slot(due_at, exclude_id=0):
+    # Move due_at past any pending post closer than SCHEDULED_POST_GAP
+    gap = timedelta(seconds=SCHEDULED_POST_GAP)
+    while True:
+        c.execute("""
+            SELECT MAX(due_at) FROM scheduled_posts
+            WHERE status = 'pending' AND id != ? AND due_at > ? AND due_at < ?
+        """, (exclude_id, (due_at - gap).strftime("%Y-%m-%d %H:%M:%S"), (due_at + gap).strftime("%Y-%m-%d %H:%M:%S")))
+        busy = c.fetchone()[0]
+        if not busy:
+            return due_at
+        due_at = datetime.strptime(busy, "%Y-%m-%d %H:%M:%S") + gap
+
+@db_write
+def create_scheduled_post(data, due_at):
+    due_at = _free_post_slot(due_at)
+    c.execute("""
+        INSERT INTO scheduled_posts (admin_id, target_channel, file_type, file_id, caption, btn_text, code, due_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (data["admin_id"], data.get("target_channel"), data.get("file_type"), data.get("file_id"), data.get("caption"),
+          data.get("btn_text"), data["code"], due_at.strftime("%Y-%m-%d %H:%M:%S"),
+          datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    return c.lastrowid, due_at
+
+@db_read
+def get_scheduled_posts(limit=20):
+    cur = _read_cursor()
+    cur.execute(f"""
+        SELECT {", ".join(SCHEDULED_POST_FIELDS)} FROM scheduled_posts
+        WHERE status = 'pending' ORDER BY due_at LIMIT ?
+    """, (limit,))
+    return [dict(zip(SCHEDULED_POST_FIELDS, row)) for row in cur.fetchall()]
+
+@db_read
+def get_scheduled_post(post_id):
+    cur = _read_cursor()
+    cur.execute(f"SELECT {', '.join(SCHEDULED_POST_FIELDS)} FROM scheduled_posts WHERE id = ?", (post_id,))
+    row = cur.fetchone()
+    return dict(zip(SCHEDULED_POST_FIELDS, row)) if row else None
+
+@db_write
+def reschedule_scheduled_post(post_id, due_at):
+    # Returns the new due time, or None if the post is no longer pending
+    due_at = _free_post_slot(due_at, post_id)
+    c.execute("UPDATE scheduled_posts SET due_at = ? WHERE id = ? AND status = 'pending'",
+              (due_at.strftime("%Y-%m-%d %H:%M:%S"), post_id))
+    return due_at if c.rowcount else None
+
+@db_write
+def finish_scheduled_post(post_id, status, error=None):
+    c.execute("UPDATE scheduled_posts SET status = ?, error = ?, sent_at = ? WHERE id = ? AND status = 'pending'",
+              (status, error, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), post_id))
+    return c.rowcount > 0
+
+# payload type -> (Bot method, file argument) for the "send" broadcast mode
+BROADCAST_SEND_METHODS = {
+    "photo": ("send_photo", "photo"),
+    "video": ("send_video", "video"),
+    "document": ("send_document", "document"),
+    "audio": ("send_audio", "audio"),
+    "voice": ("send_voice", "voice"),
+}
+
+def _make_direct_sender(bot, payload, reply_markup):
+    kind = payload.get("type")
+    if kind not in BROADCAST_SEND_METHODS:
+        return functools.partial(bot.send_message, text=payload.get("text", ""), parse_mode='HTML',
+                                 reply_markup=reply_markup)
+    method, field = BROADCAST_SEND_METHODS[kind]
+    kwargs = {field: payload["file_id"], "caption": payload.get("caption", ""), "parse_mode": 'HTML',
+              "reply_markup": reply_markup}
+    if kind in ("video", "document"):
+        kwargs["protect_content"] = True
+    return functools.partial(getattr(bot, method), **kwargs)
+
+def _make_broadcast_sender(bot, payload, reply_markup):
+    # Built once per broadcast; the returned coroutine function only takes chat_id.
+    # "copy" and "forward" reference the admin's original message, so Telegram does not have
+    # to receive the caption and file again for every recipient.
+    direct = _make_direct_sender(bot, payload, reply_markup)
+    mode = payload.get("mode", "send")
+    if mode not in ("copy", "forward") or not payload.get("source_message_id"):
+        return direct
+
+    source_kwargs = {
+        "from_chat_id": payload["source_chat_id"],
+        "message_id": payload["source_message_id"],
+        "protect_content": payload.get("type") in ("video", "document"),
     }
-    update_bot_setting(f"last_ad_state_{admin_id}", json.dumps(state))
+    if mode == "copy":
+        current = functools.partial(bot.copy_message, reply_markup=reply_markup, **source_kwargs)
+    else:
+        current = functools.partial(bot.forward_message, **source_kwargs)
 
-def load_last_ad_state(admin_id):
-    raw = get_bot_setting(f"last_ad_state_{admin_id}")
-    if not raw:
+    async def send(chat_id):
+        nonlocal current
+        try:
+            return await current(chat_id=chat_id)
+        except BadRequest as e:
+            # The admin deleted the original message: fall back to sending the content itself
+            text = str(e).lower()
+            if current is direct or "message to" not in text or "not found" not in text:
+                raise
+            logging.warning(f"Reklama manba xabari topilmadi, oddiy yuborishga o'tildi: {e}")
+            current = direct
+            return await direct(chat_id=chat_id)
+
+    return send
+
+# BadRequest texts meaning the chat itself is gone rather than the message being rejected
+DEAD_CHAT_ERRORS = ("chat not found", "user is deactivated", "peer_id_invalid", "bot can't initiate conversation")
+
+async def _send_broadcast_message(send, uid, max_attempts=3):
+    # Returns (status, uid, error): "success", "skipped" (chat unreachable) or "failed"
+    attempts = 0
+    while True:
+        try:
+            await send(chat_id=int(uid))
+            return ("success", uid, None)
+        except RetryAfter as e:
+            # The rate limiter already paused all sends and retried; give up on this recipient
+            return ("failed", uid, str(e))
+        except Forbidden as e:
+            return ("skipped", uid, str(e))
+        except BadRequest as e:
+            # BadRequest is a NetworkError subclass, so it must be caught before the retry branch
+            dead = any(text in str(e).lower() for text in DEAD_CHAT_ERRORS)
+            return ("skipped" if dead else "failed", uid, str(e))
+        except (TimedOut, NetworkError) as e:
+            attempts += 1
+            await asyncio.sleep(1 + attempts)
+            if attempts >= max_attempts:
+                logging.error(f"Network error for {uid}: {e}")
+                return ("failed", uid, str(e))
+        except Exception as e:
+            attempts += 1
+            if attempts >= max_attempts:
+                logging.error(f"Failed to send to {uid}: {e}")
+                return ("failed", uid, str(e))
+            await asyncio.sleep(0.5 + attempts)
+
+# send result -> counter in a live progress dict
+PROGRESS_KEYS = {"success": "sent", "failed": "failed", "skipped": "unreachable", "blocked": "blocked"}
+
+async def _broadcast_window(bot, recipients, payload, reply_markup, on_checkpoint, blocked=None,
+                            should_stop=None, progress=None, max_attempts=3):
+    # Keeps BROADCAST_CONCURRENCY sends in flight, starting a new one as soon as any finishes.
+    # Recipients arrive in ascending id order and results are handed to on_checkpoint in that
+    # same order, so the last id of every checkpoint is a safe resume cursor.
+    # progress counters are bumped as each send finishes. Returns True if should_stop() ended
+    # the broadcast early.
+    blocked = _blocked_ids if blocked is None else blocked
+    send = _make_broadcast_sender(bot, payload, reply_markup)
+    in_flight = set()
+    pending = OrderedDict()
+    finished = []
+    stopped = False
+
+    async def collect(done, final=False):
+        for task in done:
+            status, uid, error = task.result()
+            pending[uid] = (status, error)
+            if progress is not None:
+                progress[PROGRESS_KEYS[status]] += 1
+        while pending:
+            uid, result = next(iter(pending.items()))
+            if result is None:
+                break
+            pending.popitem(last=False)
+            finished.append((uid,) + result)
+        if finished and (final or len(finished) >= BROADCAST_CHECKPOINT_EVERY):
+            await on_checkpoint(finished[-1][0], finished[:])
+            finished.clear()
+
+    try:
+        async for uid in recipients:
+            if should_stop and should_stop():
+                stopped = True
+                break
+            if uid in blocked:
+                pending[uid] = ("blocked", None)
+                if progress is not None:
+                    progress["blocked"] += 1
+                continue
+            pending[uid] = None
+            in_flight.add(asyncio.create_task(
+                _send_broadcast_message(send, uid, max_attempts)
+            ))
+            if len(in_flight) >= BROADCAST_CONCURRENCY:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                await collect(done)
+
+        done = (await asyncio.wait(in_flight))[0] if in_flight else set()
+        await collect(done, final=True)
+    except asyncio.CancelledError:
+        # Cancelled past the drain timeout; the unsaved batch is sent again on resume
+        for task in in_flight:
+            task.cancel()
+        raise
+    return stopped
+
+# campaign_id -> requested state of campaigns running in this process:
+# "running", "paused", "cancelled" or "stopping" (bot shutdown, resumed on next start)
+_campaign_controls = {}
+
+# Long-running work started from handlers, keyed like ("campaign", 12). Handlers return at once
+# and the task reports through its own status message; stop_background_tasks drains it on shutdown.
+_background_tasks = {}
+
+def start_background_task(key, coro):
+    if key in _background_tasks:
+        coro.close()
         return None
+    task = asyncio.create_task(coro, name=f"{key[0]}-{key[1]}")
+    _background_tasks[key] = task
+    task.add_done_callback(functools.partial(_forget_background_task, key))
+    return task
+
+def _forget_background_task(key, task):
+    if _background_tasks.get(key) is task:
+        del _background_tasks[key]
+
+def get_background_tasks():
+    return [{"kind": kind, "id": task_id, "control": _campaign_controls.get(task_id) if kind == "campaign" else None}
+            for kind, task_id in list(_background_tasks)]
+
+def _campaign_control_markup(campaign_id, paused=False):
+    if paused:
+        first = InlineKeyboardButton("▶️ Davom ettirish", callback_data=f"ad_campaign_resume_{campaign_id}")
+    else:
+        first = InlineKeyboardButton("⏸ Pauza", callback_data=f"ad_campaign_pause_{campaign_id}")
+    return InlineKeyboardMarkup([
+        [first, InlineKeyboardButton("⛔️ To'xtatish", callback_data=f"ad_campaign_cancel_{campaign_id}")]
+    ])
+
+def _format_campaign_report(campaign, title):
+    not_sent = campaign["skipped_blocked"] + campaign["skipped_unreachable"] + campaign["failed"]
+    return (
+        f"{title}\n\n"
+        "━━━━━━━━━━━━━━━━━━━━\n"
+        f"🆔 Kampaniya: <b>#{campaign['id']}</b>\n"
+        f"📊 Jami user: <b>{campaign['total']}</b>\n"
+        f"✅ Yuborildi: <b>{campaign['sent']}</b>\n"
+        f"🚫 Bloklangan (DB): <b>{campaign['skipped_blocked']}</b>\n"
+        f"⏭ Yetib bormagan (o'tkazib yuborildi): <b>{campaign['skipped_unreachable']}</b>\n"
+        f"❌ Yuborilmadi (xato): <b>{campaign['failed']}</b>\n"
+        f"📌 Umumiy yuborilmadi: <b>{not_sent}</b>\n"
+        "━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+    )
+
+# campaign_id -> live counters of campaigns running in this process (see get_broadcast_metrics)
+_broadcast_progress = {}
+
+def _progress_snapshot(progress):
+    snapshot = dict(progress)
+    processed = snapshot["sent"] + snapshot["failed"] + snapshot["unreachable"] + snapshot["blocked"]
+    remaining = max(0, snapshot["total"] - processed)
+    snapshot["processed"] = processed
+    snapshot["percent"] = processed / snapshot["total"] * 100 if snapshot["total"] else 100.0
+    snapshot["eta_seconds"] = remaining / snapshot["rate"] if snapshot["rate"] > 0 else None
+    snapshot["elapsed_seconds"] = time.monotonic() - snapshot.pop("started")
+    return snapshot
+
+def get_broadcast_metrics():
+    return {
+        "campaigns": [_progress_snapshot(progress) for progress in list(_broadcast_progress.values())],
+        "background_tasks": get_background_tasks(),
+        "send_rate": send_rate_limiter.rate,
+        "retry_after_count": send_rate_limiter.retry_after_count,
+    }
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "—"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def _format_campaign_progress(snapshot, title="⏳ <b>REKLAMA YUBORILMOQDA...</b>"):
+    return (
+        f"{title}\n\n"
+        "━━━━━━━━━━━━━━━━━━━━\n"
+        f"🆔 Kampaniya: <b>#{snapshot['campaign_id']}</b>\n"
+        f"📊 Jarayon: <b>{snapshot['processed']}/{snapshot['total']}</b> ({snapshot['percent']:.1f}%)\n"
+        f"✅ Yuborildi: <b>{snapshot['sent']}</b>\n"
+        f"❌ Xato: <b>{snapshot['failed']}</b>\n"
+        f"⏭ Botni bloklagan / yetib bormagan: <b>{snapshot['unreachable']}</b>\n"
+        f"🚫 Bloklangan (DB): <b>{snapshot['blocked']}</b>\n"
+        f"⚡️ Tezlik: <b>{snapshot['rate']:.1f}</b> msg/s\n"
+        f"⏱ Qolgan vaqt: <b>~{_format_duration(snapshot['eta_seconds'])}</b>\n"
+        "━━━━━━━━━━━━━━━━━━━━"
+    )
+
+async def _report_campaign_progress(bot, campaign, progress, title=None, reply_markup=None):
+    # Runs beside the send loop and only reads the counters, so edits never slow sending down
+    last_text = None
+    last_time = time.monotonic()
+    last_processed = _progress_snapshot(progress)["processed"]
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        now = time.monotonic()
+        processed = _progress_snapshot(progress)["processed"]
+        current = (processed - last_processed) / (now - last_time)
+        progress["rate"] = current if not progress["rate"] else 0.5 * progress["rate"] + 0.5 * current
+        last_time, last_processed = now, processed
+        snapshot = _progress_snapshot(progress)
+        text = _format_campaign_progress(snapshot, title) if title else _format_campaign_progress(snapshot)
+        if text != last_text:
+            await _edit_campaign_message(bot, campaign, text, reply_markup or _campaign_control_markup(campaign["id"]))
+            last_text = text
+
+async def _edit_campaign_message(bot, campaign, text, reply_markup=None):
+    if not campaign["status_chat_id"] or not campaign["status_message_id"]:
+        return
     try:
-        return json.loads(raw)
-    except Exception:
+        await bot.edit_message_text(
+            text, chat_id=campaign["status_chat_id"], message_id=campaign["status_message_id"],
+            parse_mode='HTML', reply_markup=reply_markup
+        )
+    except Exception as e:
+        logging.warning(f"Kampaniya #{campaign['id']} xabarini yangilab bo'lmadi: {e}")
+
+async def _iter_campaign_recipients(campaign, after_user_id=None, upto_user_id=2 ** 63 - 1):
+    if after_user_id is None:
+        after_user_id = campaign["last_user_id"]
+    audience_id = campaign["id"] if campaign["segment"] else None
+    while True:
+        page = await get_broadcast_recipients_page(after_user_id, BROADCAST_CHECKPOINT_EVERY, audience_id, upto_user_id)
+        if not page:
+            return
+        for uid in page:
+            yield uid
+        after_user_id = page[-1]
+
+async def _iter_campaign_failed(campaign_id):
+    after_user_id = 0
+    while True:
+        page = await get_campaign_failed_page(campaign_id, after_user_id, BROADCAST_CHECKPOINT_EVERY)
+        if not page:
+            return
+        for uid in page:
+            yield uid
+        after_user_id = page[-1]
+
+def _retry_markup(campaign_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("♻️ Qayta yuborish", callback_data=f"ad_retry_failed_{campaign_id}"),
+         InlineKeyboardButton("❌ Bekor qilish", callback_data="ad_cancel_retry")]
+    ])
+
+def _release_campaign(campaign_id):
+    if _background_tasks.get(("campaign", campaign_id)) is asyncio.current_task():
+        _campaign_controls.pop(campaign_id, None)
+        _background_tasks.pop(("campaign", campaign_id), None)
+
+def start_broadcast_campaign(bot, campaign_id):
+    # Returns the task, or None if this campaign (or its retry) is already running
+    if ("campaign", campaign_id) in _background_tasks:
         return None
+    _campaign_controls[campaign_id] = "running"
+    task = start_background_task(("campaign", campaign_id), run_broadcast_campaign(bot, campaign_id))
+    if task:
+        task.add_done_callback(functools.partial(_on_campaign_task_done, bot, campaign_id))
+    return task
+
+def _on_campaign_task_done(bot, campaign_id, task):
+    # A crashed campaign (e.g. "database is locked") would stay 'running' with nothing sending it.
+    # Pausing it lets the admin resume from the bot; holding the slot keeps a resume from racing it.
+    if task.cancelled() or task.exception() is None:
+        return
+    start_background_task(("campaign", campaign_id), _pause_crashed_campaign(bot, campaign_id))
 
-def clear_last_ad_state(admin_id):
-    update_bot_setting(f"last_ad_state_{admin_id}", "")
-
-async def broadcast_to_users(
-    context: ContextTypes.DEFAULT_TYPE,
-    users,
-    payload,
-    reply_markup,
-    blocked_set,
-    concurrency_limit=25,
-    batch_size=200,
-    batch_pause=0.25,
-    max_attempts=3
-):
-    sem = asyncio.Semaphore(concurrency_limit)
-    success_count = 0
-    failed_ids = []
-    skipped_blocked = 0
-    skipped_unreachable_total = 0
-
-    async def send_one(uid):
-        attempts = 0
-        while True:
-            try:
-                async with sem:
-                    if payload["type"] == "photo":
-                        await context.bot.send_photo(
-                            chat_id=int(uid),
-                            photo=payload["file_id"],
-                            caption=payload.get("caption", ""),
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                    elif payload["type"] == "video":
-                        await context.bot.send_video(
-                            chat_id=int(uid),
-                            video=payload["file_id"],
-                            caption=payload.get("caption", ""),
-                            parse_mode='HTML',
-                            protect_content=True,
-                            reply_markup=reply_markup
-                        )
-                    elif payload["type"] == "document":
-                        await context.bot.send_document(
-                            chat_id=int(uid),
-                            document=payload["file_id"],
-                            caption=payload.get("caption", ""),
-                            parse_mode='HTML',
-                            protect_content=True,
-                            reply_markup=reply_markup
-                        )
-                    elif payload["type"] == "audio":
-                        await context.bot.send_audio(
-                            chat_id=int(uid),
-                            audio=payload["file_id"],
-                            caption=payload.get("caption", ""),
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                    elif payload["type"] == "voice":
-                        await context.bot.send_voice(
-                            chat_id=int(uid),
-                            voice=payload["file_id"],
-                            caption=payload.get("caption", ""),
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                    else:
-                        await context.bot.send_message(
-                            chat_id=int(uid),
-                            text=payload.get("text", ""),
-                            parse_mode='HTML',
-                            reply_markup=reply_markup
-                        )
-                return ("success", uid)
-            except RetryAfter as e:
-                attempts += 1
-                await asyncio.sleep(int(getattr(e, "retry_after", 1)) + 1)
-                if attempts >= max_attempts:
-                    return ("failed", uid)
-            except (TimedOut, NetworkError) as e:
-                attempts += 1
-                await asyncio.sleep(1 + attempts)
-                if attempts >= max_attempts:
-                    logging.error(f"Network error for {uid}: {e}")
-                    return ("failed", uid)
-            except (Forbidden, BadRequest):
-                return ("skipped", uid)
-            except Exception as e:
-                attempts += 1
-                if attempts >= max_attempts:
-                    logging.error(f"Failed to send to {uid}: {e}")
-                    return ("failed", uid)
-                await asyncio.sleep(0.5 + attempts)
-
-    users_list = list(users)
-    total = len(users_list)
-    idx = 0
-    while idx < total:
-        chunk = users_list[idx: idx + batch_size]
-        idx += batch_size
-
-        chunk_skipped_unreachable = []
-        targets = []
-        for uid in chunk:
-            if uid in blocked_set:
-                skipped_blocked += 1
-            else:
-                targets.append(uid)
+async def _pause_crashed_campaign(bot, campaign_id):
+    try:
+        campaign = await get_broadcast_campaign(campaign_id)
+        if not campaign or campaign["status"] != "running":
+            return
+        await set_broadcast_campaign_status(campaign_id, "paused")
+        campaign["status"] = "paused"
+        logging.warning(f"Kampaniya #{campaign_id} xatolik sababli pauza qilindi")
+        await _edit_campaign_message(
+            bot, campaign, _format_campaign_report(campaign, "⚠️ <b>REKLAMA XATOLIK SABABLI PAUZA QILINDI</b>"),
+            _campaign_control_markup(campaign_id, paused=True)
+        )
+    except Exception as e:
+        logging.error(f"Kampaniya #{campaign_id} pauza qilinmadi: {e}")
 
-        if not targets:
-            continue
+def start_broadcast_retry(bot, campaign_id, status_chat_id, status_message_id):
+    # Shares the campaign's slot, so a retry never overlaps the campaign itself
+    if ("campaign", campaign_id) in _background_tasks:
+        return None
+    _campaign_controls[campaign_id] = "running"
+    return start_background_task(
+        ("campaign", campaign_id), run_broadcast_retry(bot, campaign_id, status_chat_id, status_message_id)
+    )
 
-        results = await asyncio.gather(*(send_one(uid) for uid in targets))
-        for status, uid in results:
-            if status == "success":
-                success_count += 1
-            elif status == "skipped":
-                chunk_skipped_unreachable.append(uid)
+async def run_broadcast_retry(bot, campaign_id, status_chat_id, status_message_id):
+    try:
+        campaign = await get_broadcast_campaign(campaign_id)
+        campaign["status_chat_id"], campaign["status_message_id"] = status_chat_id, status_message_id
+        retry_total = campaign["failed"]
+        counts = {"success": 0, "failed": 0, "skipped": 0, "blocked": 0}
+        progress = _broadcast_progress[campaign_id] = {
+            "campaign_id": campaign_id,
+            "total": retry_total,
+            "sent": 0,
+            "failed": 0,
+            "unreachable": 0,
+            "blocked": 0,
+            "rate": 0.0,
+            "started": time.monotonic(),
+        }
+        cancel_kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⛔️ To'xtatish", callback_data=f"ad_campaign_cancel_{campaign_id}")]
+        ])
+        reporter = asyncio.create_task(_report_campaign_progress(
+            bot, campaign, progress, "⏳ <b>QAYTA YUBORILMOQDA...</b>", cancel_kb
+        ))
+
+        async def checkpoint(last_uid, results):
+            await checkpoint_broadcast_retry(campaign_id, results)
+            for _, status, _ in results:
+                counts[status] += 1
+
+        try:
+            # Pause, cancel and shutdown all just end the round; what's left stays in the retry set
+            stopped = await _broadcast_window(
+                bot, _iter_campaign_failed(campaign_id), campaign["payload"],
+                _build_markup_from_serialized(campaign["buttons"]), checkpoint,
+                should_stop=lambda: _campaign_controls.get(campaign_id) != "running", progress=progress
+            )
+        finally:
+            reporter.cancel()
+            _broadcast_progress.pop(campaign_id, None)
+        _release_campaign(campaign_id)
+
+        remaining = (await get_broadcast_campaign(campaign_id))["failed"]
+        not_sent = counts["blocked"] + counts["skipped"] + counts["failed"]
+        title = "⛔️ <b>QAYTA YUBORISH TO'XTATILDI</b>" if stopped else "✅ <b>QAYTA YUBORISH HISOBOTI</b>"
+        result_text = (
+            f"{title}\n\n"
+            "━━━━━━━━━━━━━━━━━━━━\n"
+            f"🆔 Kampaniya: <b>#{campaign_id}</b>\n"
+            f"📊 Qayta yuborish ro'yxati: <b>{retry_total}</b>\n"
+            f"✅ Yuborildi: <b>{counts['success']}</b>\n"
+            f"🚫 Bloklangan (DB): <b>{counts['blocked']}</b>\n"
+            f"⏭ Yetib bormagan (o'tkazib yuborildi): <b>{counts['skipped']}</b>\n"
+            f"❌ Yuborilmadi (xato): <b>{counts['failed']}</b>\n"
+            f"📌 Umumiy yuborilmadi: <b>{not_sent}</b>\n"
+            "━━━━━━━━━━━━━━━━━━━━\n\n"
+            f"📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+        )
+        await _edit_campaign_message(bot, campaign, result_text, _retry_markup(campaign_id) if remaining else None)
+        await log_admin_action(campaign["admin_id"], "Reklama qayta yuborildi",
+                               f"Kampaniya #{campaign_id}, Yuborildi: {counts['success']}, Yuborilmadi: {not_sent}")
+    except Exception as e:
+        logging.error(f"Kampaniya #{campaign_id} qayta yuborishda xatolik: {e}")
+    finally:
+        _release_campaign(campaign_id)
+
+async def run_broadcast_campaign(bot, campaign_id):
+    try:
+        campaign = await get_broadcast_campaign(campaign_id)
+        if not campaign or campaign["status"] != "running":
+            return
+        logging.info(f"Kampaniya #{campaign_id} boshlandi (user_id > {campaign['last_user_id']})")
+        payload = campaign["payload"]
+        reply_markup = _build_markup_from_serialized(campaign["buttons"])
+        progress = _broadcast_progress[campaign_id] = {
+            "campaign_id": campaign_id,
+            "total": campaign["total"],
+            "sent": campaign["sent"],
+            "failed": campaign["failed"],
+            "unreachable": campaign["skipped_unreachable"],
+            "blocked": campaign["skipped_blocked"],
+            "rate": 0.0,
+            "started": time.monotonic(),
+        }
+        reporter = asyncio.create_task(_report_campaign_progress(bot, campaign, progress))
+
+        async def checkpoint(last_uid, results):
+            await checkpoint_broadcast_campaign(campaign_id, last_uid, results)
+
+        try:
+            if campaign["shards"]:
+                stopped = await _run_broadcast_shards(bot, campaign, progress)
             else:
-                failed_ids.append(uid)
+                stopped = await _broadcast_window(
+                    bot, _iter_campaign_recipients(campaign), payload, reply_markup, checkpoint,
+                    should_stop=lambda: _campaign_controls.get(campaign_id) != "running", progress=progress
+                )
+        finally:
+            reporter.cancel()
+            _broadcast_progress.pop(campaign_id, None)
+        outcome = _campaign_controls.get(campaign_id, "stopping") if stopped else "done"
 
-        if chunk_skipped_unreachable:
-            skipped_unreachable_total += len(chunk_skipped_unreachable)
+        if outcome == "stopping":
+            logging.info(f"Kampaniya #{campaign_id} to'xtatildi, keyingi ishga tushishda davom etadi")
+            return
 
-        if batch_pause:
-            await asyncio.sleep(batch_pause)
+        # Release the slot first so a resume arriving right after the status write can start again
+        _release_campaign(campaign_id)
+        await set_broadcast_campaign_status(campaign_id, outcome)
+        campaign = await get_broadcast_campaign(campaign_id)
+        if outcome == "paused":
+            await _edit_campaign_message(
+                bot, campaign, _format_campaign_report(campaign, "⏸ <b>REKLAMA PAUZA QILINDI</b>"),
+                _campaign_control_markup(campaign_id, paused=True)
+            )
+            return
 
-    return success_count, failed_ids, skipped_blocked, skipped_unreachable_total
+        # Failed recipients stay in broadcast_recipients; the retry button only carries the campaign id
+        report_kb = _retry_markup(campaign_id) if campaign["failed"] else None
 
-def get_statistics():
-    c.execute("SELECT COUNT(*) FROM users")
-    total = c.fetchone()[0]
+        title = "⛔️ <b>REKLAMA TO'XTATILDI</b>" if outcome == "cancelled" else "✅ <b>REKLAMA YUBORISH HISOBOTI</b>"
+        report = _format_campaign_report(campaign, title)
+        if campaign["shards"]:
+            report += "\n\n🧩 <b>Shardlar:</b>\n" + "\n".join(
+                f"{'├' if i < campaign['shards'] - 1 else '└'} #{shard['shard']}: ✅ {shard['sent']} / ❌ {shard['failed']}"
+                f" / ⏭ {shard['skipped_unreachable']}"
+                for i, shard in enumerate(await get_broadcast_shards(campaign_id))
+            )
+        await _edit_campaign_message(bot, campaign, report, report_kb)
+        not_sent = campaign["skipped_blocked"] + campaign["skipped_unreachable"] + campaign["failed"]
+        action = "Reklama to'xtatildi" if outcome == "cancelled" else "Reklama yuborildi"
+        await log_admin_action(campaign["admin_id"], action,
+                               f"Kampaniya #{campaign_id}, Yuborildi: {campaign['sent']}, Yuborilmadi: {not_sent}")
+    except Exception as e:
+        logging.error(f"Kampaniya #{campaign_id} xatolik: {e}")
+        # Seen by _on_campaign_task_done, which pauses the campaign
+        raise
+    finally:
+        _release_campaign(campaign_id)
 
-    today = datetime.now().strftime("%Y-%m-%d")
-    c.execute("SELECT COUNT(*) FROM users WHERE join_date LIKE ?", (f"{today}%",))
-    today_joins = c.fetchone()[0]
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+async def _run_broadcast_shards(bot, campaign, progress):
+    # Coordinator: shard 0 is sent from this process through the main bot and its shared
+    # send_rate_limiter, every helper token gets a worker process (see run_broadcast_shard).
+    # Progress is read back from broadcast_shards. Returns True if the campaign did not finish.
+    campaign_id = campaign["id"]
+    await set_broadcast_shards_status(campaign_id, "running")
+    processes = {}
+
+    async def run_worker(shard):
+        shard_index, pid = shard["shard"], shard["worker_pid"]
+        if pid and _pid_alive(pid):
+            # A worker from before a restart still owns this shard; wait for it instead of doubling it
+            logging.warning(f"Kampaniya #{campaign_id}: shard #{shard_index} jarayoni (pid {pid}) hali ishlayapti, kutilmoqda")
+            while _pid_alive(pid):
+                await asyncio.sleep(1)
+            shard = next(s for s in await get_broadcast_shards(campaign_id) if s["shard"] == shard_index)
+            if shard["status"] == "done" or _campaign_controls.get(campaign_id) != "running":
+                return
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--broadcast-shard", str(campaign_id), str(shard_index)
+        )
+        processes[shard_index] = process
+        await set_broadcast_shard_worker(campaign_id, shard_index, process.pid)
+        await process.wait()
+        await set_broadcast_shard_worker(campaign_id, shard_index, None)
+
+    waiters = []
+    for shard in await get_broadcast_shards(campaign_id):
+        if shard["status"] == "done":
+            continue
+        if shard["shard"] == 0:
+            waiters.append(asyncio.create_task(_send_broadcast_shard(bot, campaign, shard)))
+        else:
+            waiters.append(asyncio.create_task(run_worker(shard)))
+    logging.info(f"Kampaniya #{campaign_id}: {len(waiters)} ta shard ishga tushdi")
 
-    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-    c.execute("SELECT COUNT(*) FROM users WHERE join_date LIKE ?", (f"{yesterday}%",))
-    yesterday_joins = c.fetchone()[0]
+    stop_requested = False
+    try:
+        while not all(waiter.done() for waiter in waiters):
+            if not stop_requested and _campaign_controls.get(campaign_id) != "running":
+                await set_broadcast_shards_status(campaign_id, "stop")
+                stop_requested = True
+            await asyncio.wait(waiters, timeout=1)
+            shards = await get_broadcast_shards(campaign_id)
+            for key, column in (("sent", "sent"), ("failed", "failed"), ("unreachable", "skipped_unreachable"),
+                                ("blocked", "skipped_blocked")):
+                progress[key] = sum(shard[column] for shard in shards)
+    except asyncio.CancelledError:
+        # Cancelled past the drain timeout: the workers had their chance to stop at a checkpoint,
+        # so end them now rather than leave them sending next to a resumed campaign
+        for waiter in waiters:
+            waiter.cancel()
+        await set_broadcast_shards_status(campaign_id, "stop")
+        for shard_index, process in processes.items():
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), 5)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+            await set_broadcast_shard_worker(campaign_id, shard_index, None)
+        raise
+
+    for waiter in waiters:
+        if waiter.exception():
+            logging.error(f"Kampaniya #{campaign_id}: shard xatolik bilan tugadi: {waiter.exception()}")
+    await merge_broadcast_shards(campaign_id)
+    shards = await get_broadcast_shards(campaign_id)
+    if not all(shard["status"] == "done" for shard in shards):
+        if _campaign_controls.get(campaign_id) == "running":
+            # A worker died without being asked to stop; pause so the admin can resume it
+            logging.error(f"Kampaniya #{campaign_id}: shard jarayoni kutilmaganda tugadi, pauza qilindi")
+            _campaign_controls[campaign_id] = "paused"
+        return True
 
-    week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("SELECT COUNT(*) FROM users WHERE join_date >= ?", (week_ago,))
-    week_joins = c.fetchone()[0]
+    # Helper bots can't reach users who never started them; those were stored as failed and
+    # now get the ad from the main bot
+    for key, column in (("sent", "sent"), ("failed", "failed"), ("unreachable", "skipped_unreachable"),
+                        ("blocked", "skipped_blocked")):
+        progress[key] = sum(shard[column] for shard in shards)
+
+    async def checkpoint(last_uid, results):
+        await checkpoint_broadcast_handoff(campaign_id, results)
+        for _, status, _ in results:
+            progress["failed"] -= 1
+            progress[PROGRESS_KEYS[status]] += 1
+
+    return await _broadcast_window(
+        bot, _iter_campaign_failed(campaign_id), campaign["payload"],
+        _build_markup_from_serialized(campaign["buttons"]), checkpoint,
+        should_stop=lambda: _campaign_controls.get(campaign_id) != "running"
+    )
 
-    hours_24_ago = (datetime.now() - timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
-    c.execute("SELECT COUNT(*) FROM users WHERE last_active >= ?", (hours_24_ago,))
-    active_users = c.fetchone()[0]
+async def _send_broadcast_shard(bot, campaign, shard):
+    campaign_id, shard_index = campaign["id"], shard["shard"]
+    payload = dict(campaign["payload"])
+    if shard_index:
+        # copy_message sources and file_ids belong to the main bot
+        payload["mode"] = "send"
+    stop = False
+
+    async def checkpoint(last_uid, results):
+        nonlocal stop
+        # Other bots may simply not have been started by the user, so only the main bot's
+        # results say anything about deliverability. A helper bot's Forbidden/chat not found
+        # is stored as failed, which the coordinator hands to the main bot afterwards.
+        if shard_index:
+            results = [(uid, "failed" if status == "skipped" else status, error) for uid, status, error in results]
+        status = await checkpoint_broadcast_shard(campaign_id, shard_index, last_uid, results, shard_index == 0)
+        stop = status != "running"
+
+    stopped = await _broadcast_window(
+        bot, _iter_campaign_recipients(campaign, shard["last_user_id"], shard["hi_user_id"]),
+        payload, _build_markup_from_serialized(campaign["buttons"]), checkpoint, should_stop=lambda: stop
+    )
+    if not stopped:
+        await finish_broadcast_shard(campaign_id, shard_index)
+    state = "to'xtatildi" if stopped else "tugadi"
+    logging.info(f"Kampaniya #{campaign_id} shard #{shard_index} {state}")
+
+async def run_broadcast_shard(campaign_id, shard_index):
+    # Worker process entry point: sends one helper-token shard with its own rate limiter
+    campaign = await get_broadcast_campaign(campaign_id)
+    shard = next(s for s in await get_broadcast_shards(campaign_id) if s["shard"] == shard_index)
+    bot = ExtBot(BROADCAST_SHARD_TOKENS[shard_index - 1], base_url=TELEGRAM_BASE_URL, rate_limiter=TokenBucketRateLimiter(
+        TELEGRAM_SEND_RATE, TELEGRAM_SEND_BURST, TELEGRAM_SEND_MIN_RATE, TELEGRAM_SEND_MAX_RETRIES
+    ))
+    async with bot:
+        await _send_broadcast_shard(bot, campaign, shard)
+
+async def resume_broadcast_campaigns(bot):
+    campaign_ids = await get_running_campaign_ids()
+    for campaign_id in campaign_ids:
+        start_broadcast_campaign(bot, campaign_id)
+    if campaign_ids:
+        logging.info(f"{len(campaign_ids)} ta kampaniya davom ettirildi")
+
+async def stop_background_tasks():
+    # Let every campaign finish and checkpoint its current batch; they stay 'running' in the DB.
+    # Whatever is still running after BACKGROUND_DRAIN_TIMEOUT is cancelled.
+    for campaign_id in list(_campaign_controls):
+        if _campaign_controls[campaign_id] == "running":
+            _campaign_controls[campaign_id] = "stopping"
+    stop_post_scheduler()
+    stop_activity_flusher()
+    tasks = list(_background_tasks.values())
+    if not tasks:
+        return
+    done, pending = await asyncio.wait(tasks, timeout=BACKGROUND_DRAIN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(f"{len(pending)} ta fon vazifasi {BACKGROUND_DRAIN_TIMEOUT:g}s ichida tugamadi, bekor qilindi")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def get_statistics():
+    await flush_user_activity()
+    return await _read_statistics()
+
+@db_read
+def _read_statistics():
+    cur = _read_cursor()
+    today = datetime.now()
+    days = [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
+    cur.execute("SELECT day, joins, active_users FROM daily_stats WHERE day >= ? AND day <= ?", (days[-1], days[0]))
+    by_day = {day: (joins, active_users) for day, joins, active_users in cur.fetchall()}
+
+    cur.execute("SELECT key, value FROM stats_counters WHERE key IN ('users_total', 'unreachable')")
+    counters = dict(cur.fetchall())
 
     return {
-        "total": total,
-        "today_joins": today_joins,
-        "yesterday_joins": yesterday_joins,
-        "week_joins": week_joins,
-        "active_users": active_users
+        "total": counters.get("users_total", 0),
+        "unreachable": counters.get("unreachable", 0),
+        "today_joins": by_day.get(days[0], (0, 0))[0],
+        "yesterday_joins": by_day.get(days[1], (0, 0))[0],
+        "week_joins": sum(joins for joins, _ in by_day.values()),
+        "active_users": by_day.get(days[0], (0, 0))[1]
     }
 
+@db_write
 def save_film(code, file_id, file_type, caption):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     c.execute("""
         INSERT INTO films (code, file_id, file_type, caption, upload_date)
         VALUES (?, ?, ?, ?, ?)
     """, (code, file_id, file_type, caption, now))
-    conn.commit()
+    _index_film(c.lastrowid, code, caption)
+    _after_commit(_adjust_films_count, 1)
+    _after_commit(invalidate_film_cache, code)
 
+@db_write
 def save_film_part(film_code, part_number, file_id, file_type, caption):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     c.execute("""
         INSERT INTO film_parts (film_code, part_number, file_id, file_type, caption, upload_date)
         VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(film_code, part_number) DO UPDATE SET
+            file_id=excluded.file_id, file_type=excluded.file_type,
+            caption=excluded.caption, upload_date=excluded.upload_date
     """, (film_code, part_number, file_id, file_type, caption, now))
-    conn.commit()
+    _after_commit(invalidate_film_cache, film_code)
+
+async def get_film_parts(film_code):
+    entry = await _get_film_entry(film_code)
+    return entry["parts"] if entry else []
 
-def get_film_parts(film_code):
-    c.execute("SELECT part_number, file_id, file_type, caption FROM film_parts WHERE film_code = ? ORDER BY part_number ASC", (film_code,))
-    return c.fetchall()
+async def get_film_part(film_code, part_number):
+    entry = await _get_film_entry(film_code)
+    return entry["parts_by_number"].get(part_number) if entry else None
 
+@db_read
 def get_bot_setting(key):
-    c.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-    result = c.fetchone()
+    cur = _read_cursor()
+    cur.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
+    result = cur.fetchone()
     return result[0] if result else None
 
+@db_write
 def update_bot_setting(key, value):
     c.execute("""
         INSERT INTO bot_settings (key, value) VALUES (?, ?)
         ON CONFLICT(key) DO UPDATE SET value = ?
     """, (key, value, value))
-    conn.commit()
 
 def to_bold(text):
     result = []
@@ -484,11 +2050,7 @@ def parse_permissions(value):
     return set(p.strip() for p in value.split(",") if p.strip())
 
 def get_admin_permissions(user_id):
-    c.execute("SELECT permissions FROM admins WHERE user_id = ?", (user_id,))
-    row = c.fetchone()
-    if not row or row[0] is None:
-        return set()
-    return parse_permissions(row[0])
+    return set(_admin_permissions.get(user_id, ()))
 
 def has_permission(user_id, key):
     if user_id == MAIN_ADMIN_ID:
@@ -498,6 +2060,7 @@ def has_permission(user_id, key):
         return True
     return key in perms
 
+@db_write
 def update_admin_permissions(user_id, permissions_set):
     if not permissions_set:
         value = ""
@@ -506,82 +2069,272 @@ def update_admin_permissions(user_id, permissions_set):
     else:
         value = ",".join(sorted(list(permissions_set)))
     c.execute("UPDATE admins SET permissions = ? WHERE user_id = ?", (value, user_id))
-    conn.commit()
-
+    _after_commit(refresh_auth_snapshot.sync)
+
+# In-memory copy of admins/blocked_users; call refresh_auth_snapshot() after changing either table
+_admin_ids = set()
+_blocked_ids = set()
+_admin_permissions = {}
+
+@db_read
+def refresh_auth_snapshot():
+    global _admin_ids, _blocked_ids, _admin_permissions
+    cur = _read_cursor()
+    cur.execute("SELECT user_id, permissions FROM admins")
+    admin_rows = cur.fetchall()
+    cur.execute("SELECT user_id FROM blocked_users")
+    blocked_ids = {row[0] for row in cur.fetchall()}
+    _admin_ids = {uid for uid, _ in admin_rows}
+    _admin_permissions = {uid: parse_permissions(perms) for uid, perms in admin_rows}
+    _blocked_ids = blocked_ids
+
+refresh_auth_snapshot.sync()
+start_db_writer()
+
+@db_write
 def update_film_caption(code, new_caption):
     c.execute("UPDATE films SET caption = ? WHERE code = ?", (new_caption, code))
-    conn.commit()
+    c.execute("SELECT id FROM films WHERE code = ?", (code,))
+    row = c.fetchone()
+    if row:
+        _index_film(row[0], code, new_caption)
+    _after_commit(invalidate_film_cache, code)
 
+@db_write
 def delete_film(code):
+    c.execute("DELETE FROM films_fts WHERE rowid IN (SELECT id FROM films WHERE code = ?)", (code,))
     c.execute("DELETE FROM films WHERE code = ?", (code,))
+    deleted = c.rowcount
     c.execute("DELETE FROM film_parts WHERE film_code = ?", (code,))
-    conn.commit()
+    _after_commit(_adjust_films_count, -deleted)
+    _after_commit(invalidate_film_cache, code)
 
+@db_write
 def update_film_file(code, file_id, file_type):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     c.execute("UPDATE films SET file_id = ?, file_type = ?, upload_date = ? WHERE code = ?", (file_id, file_type, now, code))
-    conn.commit()
+    _after_commit(invalidate_film_cache, code)
 
+@db_write
 def update_film_part_caption(film_code, part_number, new_caption):
     c.execute("UPDATE film_parts SET caption = ? WHERE film_code = ? AND part_number = ?", (new_caption, film_code, part_number))
-    conn.commit()
+    _after_commit(invalidate_film_cache, film_code)
 
+@db_write
 def update_film_part_file(film_code, part_number, file_id, file_type):
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     c.execute("UPDATE film_parts SET file_id = ?, file_type = ?, upload_date = ? WHERE film_code = ? AND part_number = ?", (file_id, file_type, now, film_code, part_number))
-    conn.commit()
+    _after_commit(invalidate_film_cache, film_code)
 
+@db_write
 def delete_film_part(film_code, part_number):
     c.execute("DELETE FROM film_parts WHERE film_code = ? AND part_number = ?", (film_code, part_number))
-    conn.commit()
-def get_film_by_code(code):
-    c.execute("SELECT file_id, file_type, caption FROM films WHERE code = ?", (code,))
-    result = c.fetchone()
-    if result:
-        return {"file_id": result[0], "file_type": result[1], "caption": result[2]}
-    return None
+    _after_commit(invalidate_film_cache, film_code)
+
+# code -> {"film": ..., "parts": [...], "parts_by_number": {...}}, least recently used first.
+# Read on the event loop and written from the DB thread, hence the lock.
+_film_cache = OrderedDict()
+_film_cache_stats = {"hits": 0, "misses": 0}
+_film_cache_lock = threading.Lock()
+# Bumped on every invalidation so a load that raced with a write is not cached
+_film_cache_generation = 0
+
+def invalidate_film_cache(code=None):
+    global _film_cache_generation
+    with _film_cache_lock:
+        _film_cache_generation += 1
+        if code is None:
+            _film_cache.clear()
+        else:
+            _film_cache.pop(code, None)
+
+def _film_cache_lookup(code):
+    with _film_cache_lock:
+        entry = _film_cache.get(code)
+        if entry is not None:
+            _film_cache.move_to_end(code)
+            _film_cache_stats["hits"] += 1
+        else:
+            _film_cache_stats["misses"] += 1
+        return entry
+
+@db_read
+def _load_film_entry(code):
+    cur = _read_cursor()
+    generation = _film_cache_generation
+    cur.execute("SELECT file_id, file_type, caption FROM films WHERE code = ?", (code,))
+    result = cur.fetchone()
+    if not result:
+        return None
+    cur.execute("SELECT part_number, file_id, file_type, caption FROM film_parts WHERE film_code = ? ORDER BY part_number ASC", (code,))
+    parts = cur.fetchall()
+    entry = {
+        "film": {"file_id": result[0], "file_type": result[1], "caption": result[2]},
+        "parts": parts,
+        "parts_by_number": {part[0]: part for part in parts}
+    }
+    with _film_cache_lock:
+        if FILM_CACHE_MAX_SIZE > 0 and generation == _film_cache_generation:
+            _film_cache[code] = entry
+            while len(_film_cache) > FILM_CACHE_MAX_SIZE:
+                _film_cache.popitem(last=False)
+    return entry
+
+async def _get_film_entry(code):
+    entry = _film_cache_lookup(code)
+    if entry is None:
+        entry = await _load_film_entry(code)
+    return entry
+
+async def get_film_by_code(code):
+    entry = await _get_film_entry(code)
+    return entry["film"] if entry else None
+
+def _build_fts_query(query):
+    # Every word must match as a prefix: "spider man" -> "spider"* "man"*
+    terms = re.findall(r"\w+", query or "")
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+@db_read
+def search_films(query, offset=0, limit=FILM_SEARCH_PAGE_SIZE):
+    cur = _read_cursor()
+    fts_query = _build_fts_query(query)
+    if not fts_query:
+        return [], 0
+    cur.execute("SELECT COUNT(*) FROM films_fts WHERE films_fts MATCH ?", (fts_query,))
+    total = cur.fetchone()[0]
+    cur.execute("""
+        SELECT f.code, films_fts.caption, f.file_type
+        FROM films_fts JOIN films f ON f.id = films_fts.rowid
+        WHERE films_fts MATCH ?
+        ORDER BY films_fts.rank
+        LIMIT ? OFFSET ?
+    """, (fts_query, limit, offset))
+    return cur.fetchall(), total
+
+@db_read
+def get_films_page(after_id=None, before_id=None, limit=10):
+    # Newest first. after_id pages towards older films, before_id towards newer ones.
+    cur = _read_cursor()
+    if after_id is not None:
+        cur.execute("SELECT id, code, caption, file_type, upload_date FROM films WHERE id < ? ORDER BY id DESC LIMIT ?",
+                    (after_id, limit))
+        return cur.fetchall()
+    if before_id is not None:
+        cur.execute("SELECT id, code, caption, file_type, upload_date FROM films WHERE id > ? ORDER BY id ASC LIMIT ?",
+                    (before_id, limit))
+        return cur.fetchall()[::-1]
+    cur.execute("SELECT id, code, caption, file_type, upload_date FROM films ORDER BY id DESC LIMIT ?", (limit,))
+    return cur.fetchall()
+
+_films_count = None
+
+async def get_films_count():
+    if _films_count is None:
+        await _count_films()
+    return _films_count
+
+@db_write
+def _count_films():
+    # Counted on the writer thread and cached through the after-commit queue, in order with the
+    # save/delete adjustments: one earlier in the same batch is already in the count and is
+    # applied (as a no-op) before the seed, one later in the batch is applied after it
+    c.execute("SELECT COUNT(*) FROM films")
+    _after_commit(_set_films_count, c.fetchone()[0])
 
-def search_films(query):
-    c.execute("SELECT code, caption, file_type FROM films WHERE code LIKE ? OR caption LIKE ?", 
-              (f"%{query}%", f"%{query}%"))
-    return c.fetchall()
+def _set_films_count(count):
+    global _films_count
+    _films_count = count
 
-def get_all_films(offset=0, limit=10):
-    c.execute("SELECT code, caption, file_type, upload_date FROM films ORDER BY id DESC LIMIT ? OFFSET ?", 
-              (limit, offset))
-    return c.fetchall()
+def _adjust_films_count(delta):
+    global _films_count
+    if _films_count is not None:
+        _films_count = max(0, _films_count + delta)
 
-def get_films_count():
-    c.execute("SELECT COUNT(*) FROM films")
-    return c.fetchone()[0]
+# (user_id, channel_username) -> (is_joined, expires_at), oldest first
+_membership_cache = OrderedDict()
 
-async def is_member(user_id):
-    channels = get_all_channels()
-    not_joined = []
-    for channel_username, channel_type, display_name, invite_link in channels:
-        if channel_type == "Telegram":
-            try:
-                # Skip invite-link style entries entirely (t.me/+ or joinchat), and any http t.me links
-                lower = (channel_username or "").lower()
-                if channel_username.startswith("http") or "t.me/+" in lower or "t.me/joinchat" in lower:
-                    continue
-                # Handle channel ID (starts with -100) or username (@...)
-                chat_id = channel_username if channel_username.startswith("-100") else channel_username
-                # Self-healing: Try to get invite link if missing
-                if not invite_link:
-                    try:
-                        invite_link = await app.bot.export_chat_invite_link(chat_id)
-                        c.execute("UPDATE channels SET invite_link = ? WHERE channel_username = ?", (invite_link, channel_username))
-                        conn.commit()
-                    except Exception as e:
-                        logging.error(f"Invite link olishda xatolik ({channel_username}): {e}")
-                member = await app.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-                if member.status not in ["member", "creator", "administrator"]:
-                    not_joined.append((channel_username, display_name, invite_link))
-            except Exception as e:
-                logging.error(f"Kanalga a'zolikni tekshirishda xatolik ({channel_username}): {e}")
-                pass
-    return not_joined
+def _membership_cache_get(user_id, channel_username):
+    key = (user_id, channel_username)
+    entry = _membership_cache.get(key)
+    if entry is None:
+        return None
+    is_joined, expires_at = entry
+    if expires_at <= time.monotonic():
+        del _membership_cache[key]
+        return None
+    _membership_cache.move_to_end(key)
+    return is_joined
+
+def _membership_cache_set(user_id, channel_username, is_joined):
+    ttl = MEMBERSHIP_CACHE_POSITIVE_TTL if is_joined else MEMBERSHIP_CACHE_NEGATIVE_TTL
+    if ttl <= 0 or MEMBERSHIP_CACHE_MAX_SIZE <= 0:
+        return
+    key = (user_id, channel_username)
+    _membership_cache[key] = (is_joined, time.monotonic() + ttl)
+    _membership_cache.move_to_end(key)
+    while len(_membership_cache) > MEMBERSHIP_CACHE_MAX_SIZE:
+        _membership_cache.popitem(last=False)
+
+def invalidate_membership_cache(channel_username=None, user_id=None):
+    if channel_username is None and user_id is None:
+        _membership_cache.clear()
+        return
+    if channel_username is not None and user_id is not None:
+        _membership_cache.pop((user_id, channel_username), None)
+        return
+    for key in list(_membership_cache.keys()):
+        if (channel_username is None or key[1] == channel_username) and (user_id is None or key[0] == user_id):
+            del _membership_cache[key]
+
+async def _check_channel_membership(user_id, channel_username, display_name, invite_link, sem):
+    # Returns the not_joined entry for this channel, or None if the user may pass
+    try:
+        # Skip invite-link style entries entirely (t.me/+ or joinchat), and any http t.me links
+        lower = (channel_username or "").lower()
+        if channel_username.startswith("http") or "t.me/+" in lower or "t.me/joinchat" in lower:
+            return None
+        # Handle channel ID (starts with -100) or username (@...)
+        chat_id = channel_username if channel_username.startswith("-100") else channel_username
+        async with sem:
+            # Self-healing: Try to get invite link if missing
+            if not invite_link:
+                try:
+                    invite_link = await app.bot.export_chat_invite_link(chat_id)
+                    await update_channel_invite_link(channel_username, invite_link)
+                except Exception as e:
+                    logging.error(f"Invite link olishda xatolik ({channel_username}): {e}")
+            is_joined = _membership_cache_get(user_id, channel_username)
+            if is_joined is None:
+                member = await asyncio.wait_for(
+                    app.bot.get_chat_member(chat_id=chat_id, user_id=user_id),
+                    timeout=MEMBERSHIP_CHECK_TIMEOUT
+                )
+                is_joined = member.status in ["member", "creator", "administrator"]
+                _membership_cache_set(user_id, channel_username, is_joined)
+        if not is_joined:
+            return (channel_username, display_name, invite_link)
+    except (asyncio.TimeoutError, TimedOut):
+        logging.warning(f"A'zolikni tekshirish vaqti tugadi ({channel_username}), policy={MEMBERSHIP_TIMEOUT_POLICY}")
+        if MEMBERSHIP_TIMEOUT_POLICY == "closed":
+            return (channel_username, display_name, invite_link)
+    except Exception as e:
+        logging.error(f"Kanalga a'zolikni tekshirishda xatolik ({channel_username}): {e}")
+    return None
+
+async def is_member(user_id, force_refresh=False):
+    channels = await get_all_channels()
+    if force_refresh:
+        # One key per channel instead of scanning the whole cache
+        for channel_username, *_ in channels:
+            invalidate_membership_cache(channel_username, user_id)
+    sem = asyncio.Semaphore(max(1, MEMBERSHIP_CHECK_CONCURRENCY))
+    results = await asyncio.gather(*(
+        _check_channel_membership(user_id, channel_username, display_name, invite_link, sem)
+        for channel_username, channel_type, display_name, invite_link in channels
+        if channel_type == "Telegram"
+    ))
+    return [entry for entry in results if entry is not None]
 
 def get_subscription_keyboard(not_joined_channels):
     keyboard = []
@@ -662,9 +2415,31 @@ def get_film_settings_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+async def build_film_search_page(search_query, page=0):
+    results, total = await search_films(search_query, page * FILM_SEARCH_PAGE_SIZE, FILM_SEARCH_PAGE_SIZE)
+    if not results:
+        return None, None
+    total_pages = (total + FILM_SEARCH_PAGE_SIZE - 1) // FILM_SEARCH_PAGE_SIZE
+    text = f"🔍 <b>Qidiruv natijalari: \"{html.escape(search_query)}\"</b> ({page + 1}/{total_pages}, jami {total})\n\n"
+    for code, caption, file_type in results:
+        text += f"📌 Kod: <code>{html.escape(code)}</code>\n"
+        text += f"   Tur: {file_type}\n"
+        if caption:
+            text += f"   Caption: {html.escape(caption[:50])}...\n"
+        text += "\n"
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅ Oldingi", callback_data=f"film_search_page_{page-1}"))
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton("Keyingi ➡", callback_data=f"film_search_page_{page+1}"))
+    keyboard = [nav_buttons] if nav_buttons else []
+    keyboard.append([InlineKeyboardButton("⬅ Orqaga", callback_data="show_film_settings")])
+    return text, InlineKeyboardMarkup(keyboard)
+
 def get_channel_post_keyboard():
     keyboard = [
         [InlineKeyboardButton("📝 Post yaratish", callback_data="create_post")],
+        [InlineKeyboardButton("🗓 Rejalashtirilgan postlar", callback_data="sched_posts")],
         [InlineKeyboardButton("⬅ Orqaga", callback_data="back_main")]
     ]
     return InlineKeyboardMarkup(keyboard)
@@ -675,7 +2450,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Siz bloklangansiz. Bot adminiga murojaat qiling.\n\n🧑‍💻 @JavohirJalilovv")
         return
     if is_admin(user.id):
-        save_user(user.id)
+        await save_user(user.id)
         if context.args:
             code = context.args[0]
             await send_film_logic(update, context, code)
@@ -704,7 +2479,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_subscription_keyboard(not_joined)
         )
         return
-    save_user(user.id)
+    await save_user(user.id)
     if context.args:
         code = context.args[0]
         await send_film_logic(update, context, code)
@@ -715,9 +2490,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def send_film_logic(update: Update, context: ContextTypes.DEFAULT_TYPE, code: str):
-    film = get_film_by_code(code)
+    film = await get_film_by_code(code)
     if film:
-        parts = get_film_parts(code)
+        note_film_request(update.effective_user.id, code)
+        parts = await get_film_parts(code)
         if parts:
             # Multi-part film
             keyboard = []
@@ -800,7 +2576,7 @@ async def send_film_logic(update: Update, context: ContextTypes.DEFAULT_TYPE, co
     else:
         # Film not found
         if code.isdigit():
-            main_channel = get_bot_setting("main_channel")
+            main_channel = await get_bot_setting("main_channel")
             if not main_channel:
                 main_channel = CHANNEL_USERNAME
             
@@ -845,7 +2621,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-    save_user(user.id)
+    await save_user(user.id)
     text = update.message.text.strip() if update.message.text else ""
 
     if text == "📢 Kanalga Post":
@@ -854,11 +2630,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "📢 <b>KANALGA POST YARATISH</b>\n\n"
                 "1-qadam: Post uchun media yuboring (Rasm, Video yoki shunchaki Matn yozing):",
                 parse_mode='HTML',
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton("❌ Bekor qilish")]], resize_keyboard=True)
+                reply_markup=ReplyKeyboardMarkup(
+                    [[KeyboardButton("🗓 Rejalashtirilgan postlar")], [KeyboardButton("❌ Bekor qilish")]],
+                    resize_keyboard=True
+                )
             )
             context.user_data["waiting_post_media"] = True
         return
 
+    if text == "🗓 Rejalashtirilgan postlar":
+        if has_permission(user.id, "POST_CREATE"):
+            context.user_data.clear()
+            view_text, view_markup = await _scheduled_posts_view()
+            await update.message.reply_text(view_text, parse_mode='HTML', reply_markup=view_markup)
+        return
+
     if text == "❌ Bekor qilish":
         context.user_data.clear()
         if is_admin(user.id):
@@ -971,7 +2757,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Ask for target channel
-        channels = get_all_channels()
+        channels = await get_all_channels()
         telegram_channels = [(u, t, n, l) for (u, t, n, l) in channels if t == "Telegram"]
         if not telegram_channels:
             await update.message.reply_text(
@@ -996,13 +2782,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "📊 Statistika":
-        stats = get_statistics()
-        c.execute("SELECT COUNT(*) FROM films")
-        films_count = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM admins")
-        admins_count = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM blocked_users")
-        blocked_count = c.fetchone()[0]
+        stats = await get_statistics()
+        films_count = await get_films_count()
+        admins_count = len(_admin_ids)
+        blocked_count = len(_blocked_ids)
+
+        cache_total = _film_cache_stats["hits"] + _film_cache_stats["misses"]
+        cache_hit_rate = (_film_cache_stats["hits"] / cache_total * 100) if cache_total else 0
 
         growth = ""
         if stats['yesterday_joins'] > 0:
@@ -1020,7 +2806,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ━━━━━━━━━━━━━━━━━━━━
 👥 <b>Foydalanuvchilar:</b>
 ├ Jami: <b>{stats['total']}</b>
-├ Faol (24 soat): <b>{stats['active_users']}</b>
+├ Yetib boriladi: <b>{stats['total'] - stats['unreachable']}</b>
+├ Botni tark etgan: <b>{stats['unreachable']}</b>
+├ Faol (bugun): <b>{stats['active_users']}</b>
 └ Bloklangan: <b>{blocked_count}</b>
 
 📈 <b>Qo'shilish:</b>
@@ -1032,6 +2820,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ├ Filmlar: <b>{films_count}</b> ta
 └ Adminlar: <b>{admins_count}</b> ta
 
+⚡️ <b>Film keshi:</b>
+├ Hit: <b>{_film_cache_stats['hits']}</b>
+├ Miss: <b>{_film_cache_stats['misses']}</b>
+└ Samaradorlik: <b>{cache_hit_rate:.1f}%</b>
+
 ━━━━━━━━━━━━━━━━━━━━
 📅 {datetime.now().strftime("%d.%m.%Y %H:%M")}
 """
@@ -1098,7 +2891,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text == "ℹ️ Bot haqida":
-        about_text = get_bot_setting("about_text")
+        about_text = await get_bot_setting("about_text")
         if not about_text:
             about_text = (
                 "ℹ️ <b>Bot haqida</b>\n\n"
@@ -1131,6 +2924,33 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["waiting_reklama_buttons"] = True
         return
 
+    if context.user_data.get("waiting_ad_segment_joined"):
+        try:
+            dates = sorted(datetime.strptime(part, "%Y-%m-%d").strftime("%Y-%m-%d") for part in text.split())
+        except ValueError:
+            dates = []
+        if len(dates) != 2:
+            await update.message.reply_text(
+                "❌ Noto'g'ri format. Misol: <code>2026-01-01 2026-01-31</code>", parse_mode='HTML'
+            )
+            return
+        context.user_data["waiting_ad_segment_joined"] = False
+        segment = context.user_data.setdefault("reklama_segment", {})
+        segment["joined_from"], segment["joined_to"] = dates
+        segment_text, segment_markup = await _ad_segment_view(context)
+        await update.message.reply_text(segment_text, parse_mode='HTML', reply_markup=segment_markup)
+        return
+
+    if context.user_data.get("waiting_ad_segment_film"):
+        if not text:
+            await update.message.reply_text("❌ Film kodini matn ko'rinishida yuboring.")
+            return
+        context.user_data["waiting_ad_segment_film"] = False
+        context.user_data.setdefault("reklama_segment", {})["film_code"] = text
+        segment_text, segment_markup = await _ad_segment_view(context)
+        await update.message.reply_text(segment_text, parse_mode='HTML', reply_markup=segment_markup)
+        return
+
     if context.user_data.get("waiting_reklama_buttons"):
         buttons = []
         if text != "0":
@@ -1171,17 +2991,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if buttons:
             preview_text += f"\n� Tugmalar: <b>{len(buttons)}</b> ta qator"
 
-        preview_text += f"\n\n👥 Yuboriladi: <b>{len(get_all_users())}</b> ta foydalanuvchiga"
+        context.user_data["reklama_preview_text"] = preview_text
 
-        keyboard = [
-            [InlineKeyboardButton("✅ Yuborish", callback_data="approve_ad")],
-            [InlineKeyboardButton("❌ Bekor qilish", callback_data="reject_ad")]
-        ]
-        
         # Show preview message with buttons if possible, otherwise just text preview
         # Usually we reply with the media AND the buttons to show exactly how it looks.
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        preview_text, reply_markup = await _ad_approve_view(context)
         
         # Send text preview first
         await update.message.reply_text(
@@ -1243,8 +3058,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
 
                 caption = film_msg.caption or ""
-                save_film(text, file_id, file_type, caption)
-                log_admin_action(user.id, "Film qo'shildi", f"Kod: {text}")
+                await save_film(text, file_id, file_type, caption)
+                await log_admin_action(user.id, "Film qo'shildi", f"Kod: {text}")
 
                 await update.message.reply_text(
                     f"✅ <b>Film muvaffaqiyatli saqlandi!</b>\n\n"
@@ -1319,18 +3134,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if context.user_data.get("waiting_about_text"):
-        update_bot_setting("about_text", text)
+        await update_bot_setting("about_text", text)
         await update.message.reply_text("✅ 'Bot haqida' ma'lumoti muvaffaqiyatli yangilandi!")
-        log_admin_action(user.id, "Bot haqida o'zgartirildi", "")
+        await log_admin_action(user.id, "Bot haqida o'zgartirildi", "")
         context.user_data.clear()
         return
 
     if context.user_data.get("waiting_main_channel"):
         new_channel = text.strip()
         if new_channel.startswith("@") or new_channel.startswith("-100"):
-            update_bot_setting("main_channel", new_channel)
+            await update_bot_setting("main_channel", new_channel)
             await update.message.reply_text(f"✅ Asosiy kanal o'zgartirildi: {new_channel}")
-            log_admin_action(user.id, "Asosiy kanal o'zgartirildi", f"{new_channel}")
+            await log_admin_action(user.id, "Asosiy kanal o'zgartirildi", f"{new_channel}")
             context.user_data.clear()
         else:
             await update.message.reply_text("❌ Iltimos, to'g'ri formatda kanal Username (@...) yoki ID (-100...) yuboring!")
@@ -1368,9 +3183,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         new_name = text.strip()
         username = context.user_data.get("rename_channel_username")
         if username and new_name:
-            c.execute("UPDATE channels SET display_name = ? WHERE channel_username = ?", (new_name, username))
-            conn.commit()
-            log_admin_action(user.id, "Kanal nomi o'zgartirildi", f"{username} -> {new_name}")
+            await rename_channel(username, new_name)
+            await log_admin_action(user.id, "Kanal nomi o'zgartirildi", f"{username} -> {new_name}")
             await update.message.reply_text(
                 "✅ Kanal nomi muvaffaqiyatli yangilandi!",
                 parse_mode='HTML',
@@ -1383,7 +3197,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if context.user_data.get("waiting_part_code"):
         # Check if code exists
-        film = get_film_by_code(text)
+        film = await get_film_by_code(text)
         if film:
             context.user_data["part_film_code"] = text
             context.user_data["waiting_part_code"] = False
@@ -1451,8 +3265,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             caption = update.message.caption_html if hasattr(update.message, 'caption_html') else (update.message.caption or f"{part_number}-qism")
             
-            save_film_part(film_code, part_number, file_id, file_type, caption)
-            log_admin_action(user.id, "Film qismi qo'shildi", f"Kod: {film_code}, Part: {part_number}")
+            await save_film_part(film_code, part_number, file_id, file_type, caption)
+            await log_admin_action(user.id, "Film qismi qo'shildi", f"Kod: {film_code}, Part: {part_number}")
             
             await update.message.reply_text(
                 f"✅ <b>{part_number}-qism muvaffaqiyatli saqlandi!</b>\n\n"
@@ -1524,7 +3338,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if context.user_data.get("waiting_film_code_delete"):
-        film = get_film_by_code(text)
+        film = await get_film_by_code(text)
         if film:
             keyboard = [
                 [InlineKeyboardButton("✅ O'chirish", callback_data=f"confirm_delete_film_{text}")],
@@ -1541,7 +3355,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if context.user_data.get("waiting_film_code_edit"):
-        film = get_film_by_code(text)
+        film = await get_film_by_code(text)
         if film:
             context.user_data["edit_film_code"] = text
             context.user_data["waiting_film_code_edit"] = False
@@ -1567,8 +3381,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("waiting_new_caption"):
         film_code = context.user_data.get("edit_film_code")
         if film_code:
-            update_film_caption(film_code, text)
-            log_admin_action(user.id, "Film tahrirlandi", f"Kod: {film_code}")
+            await update_film_caption(film_code, text)
+            await log_admin_action(user.id, "Film tahrirlandi", f"Kod: {film_code}")
             await update.message.reply_text("✅ Film caption yangilandi!")
             context.user_data.clear()
         return
@@ -1582,8 +3396,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 file_id = update.message.document.file_id
                 file_type = "document"
-            update_film_file(film_code, file_id, file_type)
-            log_admin_action(user.id, "Film fayli yangilandi", f"Kod: {film_code}")
+            await update_film_file(film_code, file_id, file_type)
+            await log_admin_action(user.id, "Film fayli yangilandi", f"Kod: {film_code}")
             await update.message.reply_text("✅ Film fayli yangilandi!", reply_markup=get_film_settings_keyboard())
             context.user_data.clear()
         else:
@@ -1600,8 +3414,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 file_id = update.message.document.file_id
                 file_type = "document"
-            update_film_part_file(film_code, part_number, file_id, file_type)
-            log_admin_action(user.id, "Film qismi tahrirlandi (fayl)", f"Kod: {film_code}, Part: {part_number}")
+            await update_film_part_file(film_code, part_number, file_id, file_type)
+            await log_admin_action(user.id, "Film qismi tahrirlandi (fayl)", f"Kod: {film_code}, Part: {part_number}")
             await update.message.reply_text("✅ Qism fayli yangilandi!", reply_markup=get_film_settings_keyboard())
             context.user_data.clear()
         else:
@@ -1611,119 +3425,175 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("waiting_part_caption_update"):
         film_code = context.user_data.get("edit_part_film_code")
         part_number = context.user_data.get("edit_part_number")
-        update_film_part_caption(film_code, part_number, text)
-        log_admin_action(user.id, "Film qismi tahrirlandi (caption)", f"Kod: {film_code}, Part: {part_number}")
+        await update_film_part_caption(film_code, part_number, text)
+        await log_admin_action(user.id, "Film qismi tahrirlandi (caption)", f"Kod: {film_code}, Part: {part_number}")
         await update.message.reply_text("✅ Qism caption yangilandi!", reply_markup=get_film_settings_keyboard())
         context.user_data.clear()
         return
 
     if context.user_data.get("waiting_film_search_query"):
-        results = search_films(text)
-        if results:
-            result_text = f"🔍 <b>Qidiruv natijalari: \"{text}\"</b>\n\n"
-            for code, caption, file_type in results[:10]:
-                result_text += f"📌 Kod: <code>{code}</code>\n"
-                result_text += f"   Tur: {file_type}\n"
-                if caption:
-                    result_text += f"   Caption: {caption[:50]}...\n"
-                result_text += "\n"
-            await update.message.reply_text(result_text, parse_mode='HTML')
+        result_text, result_markup = await build_film_search_page(text)
+        context.user_data.clear()
+        if result_text:
+            context.user_data["film_search_query"] = text
+            await update.message.reply_text(result_text, parse_mode='HTML', reply_markup=result_markup)
         else:
             await update.message.reply_text("❌ Hech narsa topilmadi!")
-        context.user_data.clear()
         return
 
     if text and not text.startswith(("ℹ️", "📢", "⚙", "📡", "🎬", "📊", "/")):
         await send_film_logic(update, context, text)
 
-async def send_channel_post(context: ContextTypes.DEFAULT_TYPE):
-    job = context.job
-    data = job.data
-    
-    target_channel = data.get("target_channel")
-    chat_id = None
-    if target_channel:
-        chat_id = target_channel if target_channel.startswith("-100") else target_channel
-    else:
-        main_channel = get_bot_setting("main_channel")
-        if not main_channel:
-            main_channel = CHANNEL_USERNAME
-        chat_id = main_channel if main_channel.startswith("-100") else (main_channel if main_channel.startswith("@") else None)
-    
-    if not chat_id:
-        logging.error("Channel not configured correctly for post")
-        return
-
-    try:
-        # Bot username for deep link
-        bot_username = context.bot.username
-        url = f"https://t.me/{bot_username}?start={data['code']}"
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(data['btn_text'], url=url)]])
-        
-        if data['file_type'] == "photo":
-            await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=data['file_id'],
-                caption=data['caption'],
-                parse_mode='HTML',
-                reply_markup=keyboard
-            )
-        elif data['file_type'] == "video":
-            await context.bot.send_video(
-                chat_id=chat_id,
-                video=data['file_id'],
-                caption=data['caption'],
-                parse_mode='HTML',
-                reply_markup=keyboard
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=data['caption'],
-                parse_mode='HTML',
-                reply_markup=keyboard,
-                disable_web_page_preview=True
-            )
-        
-        # Notify admin
-        if data.get('admin_id'):
-            await context.bot.send_message(data['admin_id'], "✅ Post kanalga yuborildi!")
-            
-    except Exception as e:
-        logging.error(f"Error sending channel post: {e}")
-        if data.get('admin_id'):
-            await context.bot.send_message(data['admin_id'], f"❌ Post yuborishda xatolik: {e}")
-
 async def send_post_to_channel_immediate(context: ContextTypes.DEFAULT_TYPE, data: dict):
+    return await send_post_to_channel(context.bot, data)
+
+async def send_post_to_channel(bot, data):
     target_channel = data.get("target_channel")
     chat_id = None
     if target_channel:
         chat_id = target_channel if target_channel.startswith("-100") else target_channel
     else:
-        main_channel = get_bot_setting("main_channel")
+        main_channel = await get_bot_setting("main_channel")
         if not main_channel:
             main_channel = CHANNEL_USERNAME
         chat_id = main_channel if main_channel.startswith("-100") else (main_channel if main_channel.startswith("@") else None)
     if not chat_id:
         return False, "Channel not configured"
     try:
-        bot_username = context.bot.username
+        bot_username = bot.username
         url = f"https://t.me/{bot_username}?start={data['code']}"
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(data['btn_text'], url=url)]])
         if data['file_type'] == "photo":
-            await context.bot.send_photo(chat_id=chat_id, photo=data['file_id'], caption=data['caption'], parse_mode='HTML', reply_markup=keyboard)
+            await bot.send_photo(chat_id=chat_id, photo=data['file_id'], caption=data['caption'], parse_mode='HTML', reply_markup=keyboard)
         elif data['file_type'] == "video":
-            await context.bot.send_video(chat_id=chat_id, video=data['file_id'], caption=data['caption'], parse_mode='HTML', reply_markup=keyboard)
+            await bot.send_video(chat_id=chat_id, video=data['file_id'], caption=data['caption'], parse_mode='HTML', reply_markup=keyboard)
         else:
-            await context.bot.send_message(chat_id=chat_id, text=data['caption'], parse_mode='HTML', reply_markup=keyboard, disable_web_page_preview=True)
+            await bot.send_message(chat_id=chat_id, text=data['caption'], parse_mode='HTML', reply_markup=keyboard, disable_web_page_preview=True)
         if data.get('admin_id'):
-            await context.bot.send_message(data['admin_id'], "✅ Post kanalga yuborildi!")
+            await bot.send_message(data['admin_id'], "✅ Post kanalga yuborildi!")
         return True, ""
     except Exception as e:
         if data.get('admin_id'):
-            await context.bot.send_message(data['admin_id'], f"❌ Post yuborishda xatolik: {e}")
+            await bot.send_message(data['admin_id'], f"❌ Post yuborishda xatolik: {e}")
         return False, str(e)
 
+_post_scheduler_wakeup = None
+_post_scheduler_stopping = False
+
+def start_post_scheduler(bot):
+    global _post_scheduler_wakeup, _post_scheduler_stopping
+    _post_scheduler_wakeup = asyncio.Event()
+    _post_scheduler_stopping = False
+    start_background_task(("scheduler", "posts"), run_post_scheduler(bot))
+
+def wake_post_scheduler():
+    # Call after the schedule changes so the scheduler re-reads the next due time
+    if _post_scheduler_wakeup:
+        _post_scheduler_wakeup.set()
+
+def stop_post_scheduler():
+    global _post_scheduler_stopping
+    _post_scheduler_stopping = True
+    wake_post_scheduler()
+
+async def run_post_scheduler(bot):
+    # Sleeps until the earliest pending post is due. Posts that came due while the bot was down
+    # go out one by one, SCHEDULED_POST_GAP apart, instead of all at once.
+    while not _post_scheduler_stopping:
+        try:
+            posts = await get_scheduled_posts(1)
+            delay = None
+            if posts:
+                delay = (datetime.strptime(posts[0]["due_at"], "%Y-%m-%d %H:%M:%S") - datetime.now()).total_seconds()
+            if posts and delay <= 0:
+                post = posts[0]
+                try:
+                    ok, err = await send_post_to_channel(bot, post)
+                except Exception as e:
+                    # Never leave it pending after an attempt, or it would be posted twice
+                    ok, err = False, str(e)
+                await finish_scheduled_post(post["id"], "sent" if ok else "failed", err or None)
+                logging.info(f"Rejalashtirilgan post #{post['id']} {'yuborildi' if ok else f'yuborilmadi: {err}'}")
+                delay = SCHEDULED_POST_GAP
+            _post_scheduler_wakeup.clear()
+            try:
+                await asyncio.wait_for(_post_scheduler_wakeup.wait(), timeout=min(delay, 3600) if delay is not None else None)
+            except asyncio.TimeoutError:
+                pass
+        except Exception as e:
+            logging.error(f"Post rejalashtiruvchida xatolik: {e}")
+            await asyncio.sleep(SCHEDULED_POST_GAP)
+
+def _format_post_time(due_at):
+    return datetime.strptime(due_at, "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y %H:%M")
+
+async def _scheduled_posts_view():
+    posts = await get_scheduled_posts()
+    back = [InlineKeyboardButton("⬅ Orqaga", callback_data="back_main")]
+    if not posts:
+        return "🗓 <b>REJALASHTIRILGAN POSTLAR</b>\n\nHozircha rejalashtirilgan post yo'q.", InlineKeyboardMarkup([back])
+    lines = [
+        f"#{post['id']} • {_format_post_time(post['due_at'])} • {html.escape(post['target_channel'] or '')} • "
+        f"<code>{html.escape(post['code'])}</code>"
+        for post in posts
+    ]
+    keyboard = [[InlineKeyboardButton(f"🕒 #{post['id']} — {_format_post_time(post['due_at'])}",
+                                      callback_data=f"sched_post_{post['id']}")] for post in posts]
+    keyboard.append(back)
+    return "🗓 <b>REJALASHTIRILGAN POSTLAR</b>\n\n" + "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+def _scheduled_post_view(post):
+    text = (
+        f"🕒 <b>POST #{post['id']}</b>\n\n"
+        f"📡 Kanal: {html.escape(post['target_channel'] or '')}\n"
+        f"🎬 Kod: <code>{html.escape(post['code'])}</code>\n"
+        f"⏰ Vaqt: <b>{_format_post_time(post['due_at'])}</b>"
+    )
+    keyboard = [
+        [InlineKeyboardButton("+1 soat", callback_data=f"sched_post_delay_{post['id']}_1"),
+         InlineKeyboardButton("+3 soat", callback_data=f"sched_post_delay_{post['id']}_3"),
+         InlineKeyboardButton("+24 soat", callback_data=f"sched_post_delay_{post['id']}_24")],
+        [InlineKeyboardButton("⏩ Hozir yuborish", callback_data=f"sched_post_now_{post['id']}")],
+        [InlineKeyboardButton("🗑 Bekor qilish", callback_data=f"sched_post_cancel_{post['id']}")],
+        [InlineKeyboardButton("⬅ Orqaga", callback_data="sched_posts")]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def _ad_approve_view(context):
+    segment = context.user_data.get("reklama_segment") or None
+    text = (
+        context.user_data.get("reklama_preview_text", "")
+        + f"\n\n🎯 Auditoriya: <b>{describe_segment(segment)}</b>"
+        + f"\n👥 Yuboriladi: <b>{await count_broadcast_audience(segment)}</b> ta foydalanuvchiga"
+    )
+    keyboard = [
+        [InlineKeyboardButton("✅ Yuborish", callback_data="approve_ad")],
+        [InlineKeyboardButton("↪️ Forward qilish (tugmalarsiz)", callback_data="approve_ad_forward")],
+        [InlineKeyboardButton("🎯 Auditoriyani tanlash", callback_data="ad_segment")],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data="reject_ad")]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def _ad_segment_view(context):
+    segment = context.user_data.get("reklama_segment") or None
+    text = (
+        "🎯 <b>AUDITORIYA TANLASH</b>\n\n"
+        "Tanlangan filtrlar birgalikda qo'llaniladi.\n\n"
+        f"Hozirgi auditoriya: <b>{describe_segment(segment)}</b>\n"
+        f"👥 Mos foydalanuvchilar: <b>{await count_broadcast_audience(segment)}</b> ta"
+    )
+    keyboard = [
+        [InlineKeyboardButton("🟢 Faol: 7 kun", callback_data="ad_seg_active_7"),
+         InlineKeyboardButton("🟢 Faol: 30 kun", callback_data="ad_seg_active_30")],
+        [InlineKeyboardButton("📅 Qo'shilgan sana oralig'i", callback_data="ad_seg_joined")],
+        [InlineKeyboardButton("🎬 Film kodini so'raganlar", callback_data="ad_seg_film")],
+        [InlineKeyboardButton("🎲 Tasodifiy 10%", callback_data="ad_seg_sample_10"),
+         InlineKeyboardButton("🎲 Tasodifiy 50%", callback_data="ad_seg_sample_50")],
+        [InlineKeyboardButton("♻️ Hammaga", callback_data="ad_seg_clear"),
+         InlineKeyboardButton("✅ Tayyor", callback_data="ad_seg_done")]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1800,15 +3670,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
              return
 
         delay = 0
-        msg_text = ""
         
-        if schedule_type == "now":
-            delay = 0
-            msg_text = "✅ Post hozir yuborilmoqda..."
-        elif schedule_type.endswith("h"):
-            hours = int(schedule_type[:-1])
-            delay = hours * 3600
-            msg_text = f"✅ Post {hours} soatdan keyin yuboriladi."
+        if schedule_type.endswith("h"):
+            delay = int(schedule_type[:-1]) * 3600
         
         if delay == 0:
             ok, err = await send_post_to_channel_immediate(context, post_data)
@@ -1818,11 +3682,58 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.edit_text(f"❌ Xatolik: {err}")
             context.user_data.clear()
         else:
-            context.job_queue.run_once(send_channel_post, delay, data=post_data)
-            await query.message.edit_text(msg_text)
+            # Stored so a restart doesn't drop it; run_post_scheduler sends it
+            post_id, due_at = await create_scheduled_post(post_data, datetime.now() + timedelta(seconds=delay))
+            wake_post_scheduler()
+            await query.message.edit_text(
+                f"✅ Post #{post_id} {due_at.strftime('%d.%m.%Y %H:%M')} da yuboriladi.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🗓 Rejalashtirilgan postlar", callback_data="sched_posts")]
+                ])
+            )
+            await log_admin_action(user_id, "Post rejalashtirildi", f"Post #{post_id}, {due_at.strftime('%d.%m.%Y %H:%M')}")
             context.user_data.clear()
         return
 
+    if query.data == "sched_posts" or query.data.startswith("sched_post_"):
+        if not has_permission(user_id, "POST_CREATE"):
+            await query.answer("Sizda ruxsat yo'q!", show_alert=True)
+            return
+        if query.data != "sched_posts":
+            parts = query.data.split("_")
+            post_id = int(parts[3] if len(parts) > 3 else parts[2])
+            post = await get_scheduled_post(post_id)
+            if not post or post["status"] != "pending":
+                await query.answer("Post allaqachon yuborilgan yoki bekor qilingan.", show_alert=True)
+                post = None
+            elif query.data.startswith(("sched_post_delay_", "sched_post_now_")):
+                if query.data.startswith("sched_post_delay_"):
+                    due_at = datetime.strptime(post["due_at"], "%Y-%m-%d %H:%M:%S") + timedelta(hours=int(parts[4]))
+                else:
+                    due_at = datetime.now()
+                due_at = await reschedule_scheduled_post(post_id, due_at)
+                if due_at:
+                    wake_post_scheduler()
+                    post["due_at"] = due_at.strftime("%Y-%m-%d %H:%M:%S")
+                    await query.answer(f"⏰ Post {_format_post_time(post['due_at'])} da yuboriladi.", show_alert=True)
+                    await log_admin_action(user_id, "Post vaqti o'zgartirildi", f"Post #{post_id}, {_format_post_time(post['due_at'])}")
+                else:
+                    await query.answer("Post allaqachon yuborilgan yoki bekor qilingan.", show_alert=True)
+                    post = None
+            elif query.data.startswith("sched_post_cancel_"):
+                await finish_scheduled_post(post_id, "cancelled")
+                wake_post_scheduler()
+                await query.answer("🗑 Post bekor qilindi.", show_alert=True)
+                await log_admin_action(user_id, "Post bekor qilindi", f"Post #{post_id}")
+                post = None
+            if post:
+                view_text, view_markup = _scheduled_post_view(post)
+                await query.message.edit_text(view_text, parse_mode='HTML', reply_markup=view_markup)
+                return
+        view_text, view_markup = await _scheduled_posts_view()
+        await query.message.edit_text(view_text, parse_mode='HTML', reply_markup=view_markup)
+        return
+
     # 1. Membership check (admins are exempt)
     if query.data != "check_membership" and not is_admin(user_id):
         not_joined = await is_member(user_id)
@@ -1859,9 +3770,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("Siz bloklangansiz!", show_alert=True)
             return
             
-        not_joined = await is_member(user_id)
+        not_joined = await is_member(user_id, force_refresh=True)
         if not not_joined:
-            save_user(user_id)
+            await save_user(user_id)
             if is_admin(user_id):
                 await query.message.reply_text(
                     "✅ Botdan foydalanishingiz mumkin.\n\n🎛 <b>ADMIN PANEL</b>",
@@ -1957,11 +3868,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     elif query.data == "admin_remove":
-        c.execute("SELECT user_id FROM admins WHERE user_id != ?", (MAIN_ADMIN_ID,))
-        admins = c.fetchall()
+        admins = sorted(uid for uid in _admin_ids if uid != MAIN_ADMIN_ID)
         if admins:
             keyboard = []
-            for (admin_id,) in admins:
+            for admin_id in admins:
                 keyboard.append([InlineKeyboardButton(f"🗑 {admin_id}", callback_data=f"del_admin_{admin_id}")])
             keyboard.append([InlineKeyboardButton("⬅ Orqaga", callback_data="show_admin_settings")])
             keyboard.append([InlineKeyboardButton("🏠 Asosiy menyu", callback_data="return_main_menu")])
@@ -1997,9 +3907,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not has_permission(user_id, "ADMIN_REMOVE"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
-            c.execute("DELETE FROM admins WHERE user_id = ?", (admin_to_del,))
-            conn.commit()
-            log_admin_action(user_id, "Admin o'chirildi", f"ID: {admin_to_del}")
+            await remove_admin(admin_to_del)
+            await log_admin_action(user_id, "Admin o'chirildi", f"ID: {admin_to_del}")
             await query.message.edit_text(
                 f"✅ Admin muvaffaqiyatli o'chirildi!\n\nID: <code>{admin_to_del}</code>",
                 parse_mode='HTML',
@@ -2023,10 +3932,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
             try:
-                c.execute("INSERT INTO blocked_users (user_id, blocked_by, blocked_date) VALUES (?, ?, ?)",
-                          (block_user_id, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-                conn.commit()
-                log_admin_action(user_id, "User bloklandi", f"ID: {block_user_id}")
+                await block_user(block_user_id, user_id)
+                await log_admin_action(user_id, "User bloklandi", f"ID: {block_user_id}")
                 await query.message.edit_text(f"✅ User muvaffaqiyatli bloklandi!\n\nID: <code>{block_user_id}</code>", parse_mode='HTML')
             except:
                 await query.message.edit_text("❌ Bu user allaqachon bloklangan!")
@@ -2047,13 +3954,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not has_permission(user_id, "USER_UNBLOCK"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
-            c.execute("DELETE FROM blocked_users WHERE user_id = ?", (unblock_user_id,))
-            conn.commit()
-            log_admin_action(user_id, "User blokdan chiqarildi", f"ID: {unblock_user_id}")
+            await unblock_user(unblock_user_id)
+            await log_admin_action(user_id, "User blokdan chiqarildi", f"ID: {unblock_user_id}")
             await query.message.edit_text(f"✅ User muvaffaqiyatli blokdan chiqarildi!\n\nID: <code>{unblock_user_id}</code>", parse_mode='HTML')
 
     elif query.data == "edit_about_text":
-        current_text = get_bot_setting("about_text")
+        current_text = await get_bot_setting("about_text")
         if not current_text:
             current_text = "Hozircha ma'lumot yo'q."
             
@@ -2076,15 +3982,14 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 filename="users.db",
                 caption="📥 Users database"
             )
-            log_admin_action(user_id, "Users.db yuklab olindi", "")
+            await log_admin_action(user_id, "Users.db yuklab olindi", "")
 
     elif query.data == "download_logs":
         if not has_permission(user_id, "LOGS_DOWNLOAD"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
             await query.message.edit_text("📥 Admin loglari tayyorlanmoqda...")
-            c.execute("SELECT * FROM admin_logs ORDER BY id DESC LIMIT 1000")
-            logs = c.fetchall()
+            logs = await get_admin_logs(1000)
             
             csv_file = "admin_logs.csv"
             with open(csv_file, "w", newline="", encoding="utf-8") as f:
@@ -2099,15 +4004,14 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 caption="📋 Admin logs (oxirgi 1000 ta)"
             )
             os.remove(csv_file)
-            log_admin_action(user_id, "Admin loglari yuklab olindi", "")
+            await log_admin_action(user_id, "Admin loglari yuklab olindi", "")
 
     elif query.data == "download_blocked":
         if not has_permission(user_id, "LOGS_DOWNLOAD"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
             await query.message.edit_text("📥 Bloklanganlar fayli tayyorlanmoqda...")
-            c.execute("SELECT user_id, blocked_by, blocked_date, reason FROM blocked_users ORDER BY blocked_date DESC")
-            rows = c.fetchall()
+            rows = await get_blocked_users()
             csv_file = "blocked_users.csv"
             admin_count = 0
             auto_count = 0
@@ -2130,7 +4034,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 caption="⛔ Bloklanganlar ro'yxati (kategoriya bilan)"
             )
             os.remove(csv_file)
-            log_admin_action(user_id, "Bloklanganlar fayli yuklandi", f"admin={admin_count}, bot={auto_count}, total={len(rows)}")
+            await log_admin_action(user_id, "Bloklanganlar fayli yuklandi", f"admin={admin_count}, bot={auto_count}, total={len(rows)}")
 
     elif query.data == "reset_db":
         await query.answer("Bu funksiya o'chirilgan.", show_alert=True)
@@ -2141,11 +4045,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not has_permission(user_id, "ADMIN_ADD"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
-            c.execute("SELECT user_id, permissions FROM admins ORDER BY user_id")
-            admins = c.fetchall()
+            admins = sorted(_admin_ids)
             if admins:
                 keyboard = []
-                for admin_id_value, perms in admins:
+                for admin_id_value in admins:
                     keyboard.append([InlineKeyboardButton(f"{admin_id_value}", callback_data=f"perm_edit_{admin_id_value}")])
                 keyboard.append([InlineKeyboardButton("⬅ Orqaga", callback_data="show_admin_settings")])
                 await query.message.edit_text(
@@ -2197,10 +4100,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Or fail gracefully? Let's add it, maybe they make bot admin later.
         
         try:
-            c.execute("INSERT INTO channels (channel_username, channel_type, added_by, added_date, display_name, invite_link) VALUES (?, ?, ?, ?, ?, ?)",
-                      (channel_username, channel_type, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), display_name, invite_link))
-            conn.commit()
-            log_admin_action(user_id, "Kanal qo'shildi", f"{channel_username}")
+            await add_channel(channel_username, channel_type, user_id, display_name, invite_link)
+            invalidate_membership_cache(channel_username)
+            await log_admin_action(user_id, "Kanal qo'shildi", f"{channel_username}")
             await query.message.edit_text(f"✅ Kanal muvaffaqiyatli qo'shildi!\n\n{channel_username}\nNomi: {display_name}", parse_mode='HTML')
         except sqlite3.IntegrityError:
             await query.message.edit_text("❌ Bu kanal allaqachon qo'shilgan!")
@@ -2212,7 +4114,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not has_permission(user_id, "CHANNEL_REMOVE"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
-            channels = get_all_channels()
+            channels = await get_all_channels()
             if channels:
                 keyboard = []
                 for username, ch_type, display_name, invite_link in channels:
@@ -2233,7 +4135,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
 
     elif query.data == "channel_rename":
-        channels = get_all_channels()
+        channels = await get_all_channels()
         if channels:
             keyboard = []
             for username, ch_type, display_name, invite_link in channels:
@@ -2256,7 +4158,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not has_permission(user_id, "MAIN_CHANNEL_CHANGE"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
-            current_main = get_bot_setting("main_channel")
+            current_main = await get_bot_setting("main_channel")
             if not current_main:
                 current_main = CHANNEL_USERNAME
                 
@@ -2289,9 +4191,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
             channel_to_del = query.data.replace("confirm_del_channel_", "")
-            c.execute("DELETE FROM channels WHERE channel_username = ?", (channel_to_del,))
-            conn.commit()
-            log_admin_action(user_id, "Kanal o'chirildi", f"{channel_to_del}")
+            await delete_channel(channel_to_del)
+            invalidate_membership_cache(channel_to_del)
+            await log_admin_action(user_id, "Kanal o'chirildi", f"{channel_to_del}")
             await query.message.edit_text(
                 f"✅ Kanal muvaffaqiyatli o'chirildi!\n\n{channel_to_del}",
                 parse_mode='HTML',
@@ -2371,11 +4273,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             perms = context.user_data.get("perm_selected", set())
             if target_admin:
                 try:
-                    c.execute("INSERT OR IGNORE INTO admins (user_id, added_by, added_date) VALUES (?, ?, ?)",
-                              (target_admin, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-                    conn.commit()
-                    update_admin_permissions(target_admin, perms)
-                    log_admin_action(user_id, "Admin qo'shildi", f"ID: {target_admin}")
+                    await add_admin(target_admin, user_id)
+                    await update_admin_permissions(target_admin, perms)
+                    await log_admin_action(user_id, "Admin qo'shildi", f"ID: {target_admin}")
                     await query.message.edit_text(
                         f"✅ Admin qo'shildi va huquqlar saqlandi!\nID: <code>{target_admin}</code>",
                         parse_mode='HTML',
@@ -2394,8 +4294,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             target_admin = context.user_data.get("perm_target_admin_id")
             perms = context.user_data.get("perm_selected", set())
             if target_admin:
-                update_admin_permissions(target_admin, perms)
-                log_admin_action(user_id, "Admin huquqlari o'zgartirildi", f"ID: {target_admin}")
+                await update_admin_permissions(target_admin, perms)
+                await log_admin_action(user_id, "Admin huquqlari o'zgartirildi", f"ID: {target_admin}")
                 await query.message.edit_text(
                     f"✅ Admin huquqlari yangilandi!\nID: <code>{target_admin}</code>",
                     parse_mode='HTML',
@@ -2409,7 +4309,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
          await query.answer("⚠️ Bu kanal uchun havola topilmadi. Admin hali qo'shmagan bo'lishi mumkin.", show_alert=True)
 
     elif query.data == "channel_list":
-        channels = get_all_channels()
+        channels = await get_all_channels()
         if channels:
             text = "📋 <b>MAJBURIY KANALLAR</b>\n\n"
             for idx, (username, ch_type, display_name, invite_link) in enumerate(channels, 1):
@@ -2447,8 +4347,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
             film_code = query.data.replace("confirm_delete_film_", "")
-            delete_film(film_code)
-            log_admin_action(user_id, "Film o'chirildi", f"Kod: {film_code}")
+            await delete_film(film_code)
+            await log_admin_action(user_id, "Film o'chirildi", f"Kod: {film_code}")
             await query.message.edit_text(f"✅ Film o'chirildi!\n\nKod: <code>{film_code}</code>", parse_mode='HTML')
 
     elif query.data == "film_edit":
@@ -2485,7 +4385,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
             film_code = query.data.replace("film_parts_list_", "")
-            parts = get_film_parts(film_code)
+            parts = await get_film_parts(film_code)
             if not parts:
                 await query.message.edit_text("❌ Bu filmda qismlar yo'q!", reply_markup=get_film_settings_keyboard())
             else:
@@ -2560,8 +4460,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             suffix = query.data.replace("confirm_del_part_", "", 1)
             film_code, part_num = suffix.rsplit("_", 1)
             part_number = int(part_num)
-            delete_film_part(film_code, part_number)
-            log_admin_action(user_id, "Film qismi o'chirildi", f"Kod: {film_code}, Part: {part_number}")
+            await delete_film_part(film_code, part_number)
+            await log_admin_action(user_id, "Film qismi o'chirildi", f"Kod: {film_code}, Part: {part_number}")
             await query.message.edit_text("✅ Qism o'chirildi!", parse_mode='HTML', reply_markup=get_film_settings_keyboard())
 
     elif query.data == "film_search":
@@ -2572,20 +4472,44 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         context.user_data["waiting_film_search_query"] = True
 
-    elif query.data == "film_list" or query.data.startswith("film_list_page_"):
+    elif query.data.startswith("film_search_page_"):
+        search_query = context.user_data.get("film_search_query")
+        if not search_query:
+            await query.answer("Qidiruv muddati tugagan. Qaytadan qidiring.", show_alert=True)
+            return
+        page = int(query.data.split("_")[-1])
+        result_text, result_markup = await build_film_search_page(search_query, page)
+        if result_text:
+            await query.message.edit_text(result_text, parse_mode='HTML', reply_markup=result_markup)
+        else:
+            await query.answer("❌ Hech narsa topilmadi!", show_alert=True)
+
+    elif query.data == "film_list" or query.data.startswith(("film_list_next_", "film_list_prev_")):
+        # callback_data: film_list_next_{page}_{last_id} / film_list_prev_{page}_{first_id}
         page = 0
-        if query.data.startswith("film_list_page_"):
-            page = int(query.data.split("_")[-1])
+        after_id = None
+        before_id = None
+        if query.data != "film_list":
+            direction, page_str, cursor_str = query.data.replace("film_list_", "", 1).split("_")
+            page = int(page_str)
+            if direction == "next":
+                after_id = int(cursor_str)
+            else:
+                before_id = int(cursor_str)
         
         limit = 10
-        offset = page * limit
-        films = get_all_films(offset, limit)
-        total_films = get_films_count()
-        total_pages = (total_films + limit - 1) // limit
+        films = await get_films_page(after_id=after_id, before_id=before_id, limit=limit)
+        if before_id is not None and len(films) < limit:
+            # Films were deleted meanwhile; fall back to the first page
+            page = 0
+            films = await get_films_page(limit=limit)
+        total_films = await get_films_count()
+        total_pages = max(1, (total_films + limit - 1) // limit)
+        page = min(page, total_pages - 1)
 
         if films:
             text = f"📋 <b>BARCHA FILMLAR</b> ({page + 1}/{total_pages})\n\n"
-            for code, caption, file_type, upload_date in films:
+            for film_id, code, caption, file_type, upload_date in films:
                 text += f"📌 <code>{code}</code> ({file_type})\n"
                 if caption:
                     text += f"   {caption[:40]}...\n"
@@ -2594,9 +4518,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard = []
             nav_buttons = []
             if page > 0:
-                nav_buttons.append(InlineKeyboardButton("⬅ Oldingi", callback_data=f"film_list_page_{page-1}"))
-            if page < total_pages - 1:
-                nav_buttons.append(InlineKeyboardButton("Keyingi ➡", callback_data=f"film_list_page_{page+1}"))
+                nav_buttons.append(InlineKeyboardButton("⬅ Oldingi", callback_data=f"film_list_prev_{page-1}_{films[0][0]}"))
+            if page < total_pages - 1 and len(films) == limit:
+                nav_buttons.append(InlineKeyboardButton("Keyingi ➡", callback_data=f"film_list_next_{page+1}_{films[-1][0]}"))
             if nav_buttons:
                 keyboard.append(nav_buttons)
             keyboard.append([InlineKeyboardButton("⬅ Orqaga", callback_data="show_film_settings")])
@@ -2635,7 +4559,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             buttons = context.user_data.get("post_buttons", [])
             reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
             
-            channels = get_all_channels()
+            channels = await get_all_channels()
             count = 0
             for channel_username, channel_type, display_name, invite_link in channels:
                 if channel_type == "Telegram":
@@ -2662,13 +4586,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             part_num = int(parts[3])
             
             # Find specific part
-            film_parts = get_film_parts(code)
-            target_part = None
-
-            for p in film_parts:
-                if p[0] == part_num:
-                    target_part = p
-                    break
+            target_part = await get_film_part(code, part_num)
             
             if target_part:
                 # part: (part_number, file_id, file_type, caption)
@@ -2707,7 +4625,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ])
         )
 
-    elif query.data == "approve_ad":
+    elif query.data in ("approve_ad", "approve_ad_forward"):
         if not has_permission(user_id, "AD_SEND"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
@@ -2717,7 +4635,6 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             
             buttons = context.user_data.get("reklama_buttons", [])
-            reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
             buttons_serialized = _serialize_buttons(buttons) if buttons else []
             
             if reklama_msg.photo:
@@ -2755,114 +4672,133 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "type": "text",
                     "text": (reklama_msg.text_html if hasattr(reklama_msg, "text_html") else (reklama_msg.text or ""))
                 }
+            # The admin's own message is the source for copy/forward; the fields above are the
+            # fallback if it gets deleted while the campaign is running
+            payload["mode"] = "forward" if query.data == "approve_ad_forward" else BROADCAST_MODE
+            payload["source_chat_id"] = reklama_msg.chat_id
+            payload["source_message_id"] = reklama_msg.message_id
             
-            await query.message.edit_text(
-                "⏳ <b>Reklama yuborilmoqda...</b>\n\nIltimos kuting...",
-                parse_mode='HTML'
-            )
-            
-            users = get_all_users()
-            c.execute("SELECT user_id FROM blocked_users")
-            blocked_set = set(row[0] for row in c.fetchall())
-            
-            success_count, failed_ids, skipped_blocked, skipped_unreachable = await broadcast_to_users(
-                context=context,
-                users=users,
-                payload=payload,
-                reply_markup=reply_markup,
-                blocked_set=blocked_set
+            campaign_id = await create_broadcast_campaign(
+                user_id, payload, buttons_serialized, query.message.chat_id, query.message.message_id,
+                segment=context.user_data.get("reklama_segment") or None
             )
-            
-            failed_count = len(failed_ids)
-            not_sent = skipped_blocked + skipped_unreachable + failed_count
-            
-            if failed_ids:
-                save_last_ad_state(user_id, payload, failed_ids, buttons_serialized)
-                report_kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("♻️ Qayta yuborish", callback_data="ad_retry_failed"),
-                     InlineKeyboardButton("❌ Bekor qilish", callback_data="ad_cancel_retry")]
-                ])
-            else:
-                clear_last_ad_state(user_id)
-                report_kb = None
-            
-            result_text = (
-                "✅ <b>REKLAMA YUBORISH HISOBOTI</b>\n\n"
-                "━━━━━━━━━━━━━━━━━━━━\n"
-                f"📊 Jami user: <b>{len(users)}</b>\n"
-                f"✅ Yuborildi: <b>{success_count}</b>\n"
-                f"🚫 Bloklangan (DB): <b>{skipped_blocked}</b>\n"
-                f"⏭ Yetib bormagan (o'tkazib yuborildi): <b>{skipped_unreachable}</b>\n"
-                f"❌ Yuborilmadi (xato): <b>{failed_count}</b>\n"
-                f"📌 Umumiy yuborilmadi: <b>{not_sent}</b>\n"
-                "━━━━━━━━━━━━━━━━━━━━\n\n"
-                f"📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+            await query.message.edit_text(
+                f"⏳ <b>Reklama yuborilmoqda...</b>\n\n🆔 Kampaniya: <b>#{campaign_id}</b>\n"
+                "Bot qayta ishga tushsa ham yuborish to'xtagan joyidan davom etadi.",
+                parse_mode='HTML',
+                reply_markup=_campaign_control_markup(campaign_id)
             )
-            
-            await query.message.edit_text(result_text, parse_mode='HTML', reply_markup=report_kb)
-            log_admin_action(user_id, "Reklama yuborildi", f"Yuborildi: {success_count}, Yuborilmadi: {not_sent}")
+            if BROADCAST_SHARD_TOKENS and payload["type"] == "text":
+                await create_broadcast_shards(campaign_id, 1 + len(BROADCAST_SHARD_TOKENS))
+            start_broadcast_campaign(context.bot, campaign_id)
+            await log_admin_action(user_id, "Reklama boshlandi", f"Kampaniya #{campaign_id}")
             context.user_data.clear()
     
-    elif query.data == "ad_retry_failed":
+    elif query.data == "ad_retry_failed" or query.data.startswith("ad_retry_failed_"):
         if not has_permission(user_id, "AD_SEND"):
             await query.answer("Sizda ruxsat yo'q!", show_alert=True)
         else:
-            state = load_last_ad_state(user_id)
-            if not state or not state.get("failed"):
+            if query.data == "ad_retry_failed":
+                # Report messages from before campaigns carried their id
+                campaign_id = await get_latest_retry_campaign_id(user_id)
+            else:
+                campaign_id = int(query.data.rsplit("_", 1)[1])
+            campaign = await get_broadcast_campaign(campaign_id) if campaign_id else None
+            if not campaign or not campaign["failed"]:
                 await query.answer("Qayta yuboriladigan user qolmadi.", show_alert=True)
                 return
-            
-            payload = state.get("payload", {})
-            failed_ids = state.get("failed", [])
-            reply_markup = _build_markup_from_serialized(state.get("buttons", []))
+            if ("campaign", campaign_id) in _background_tasks:
+                await query.answer("Bu kampaniya hozir yuborilmoqda.", show_alert=True)
+                return
             
             await query.message.edit_text(
-                "⏳ <b>Qayta yuborish boshlandi...</b>\n\nFaqat yuborilmay qolganlarga yuboriladi.",
+                f"⏳ <b>Qayta yuborish boshlandi...</b>\n\n🆔 Kampaniya: <b>#{campaign_id}</b>\n"
+                "Faqat yuborilmay qolganlarga yuboriladi.",
                 parse_mode='HTML'
             )
-            
-            c.execute("SELECT user_id FROM blocked_users")
-            blocked_set = set(row[0] for row in c.fetchall())
-            
-            success_count, new_failed_ids, skipped_blocked, skipped_unreachable = await broadcast_to_users(
-                context=context,
-                users=failed_ids,
-                payload=payload,
-                reply_markup=reply_markup,
-                blocked_set=blocked_set
+            start_broadcast_retry(context.bot, campaign_id, query.message.chat_id, query.message.message_id)
+            await log_admin_action(user_id, "Reklama qayta yuborish boshlandi", f"Kampaniya #{campaign_id}")
+    
+    elif query.data == "ad_segment" or query.data.startswith("ad_seg_"):
+        if not has_permission(user_id, "AD_SEND"):
+            await query.answer("Sizda ruxsat yo'q!", show_alert=True)
+            return
+        if not context.user_data.get("reklama_content"):
+            await query.answer("Reklama topilmadi!", show_alert=True)
+            return
+        segment = context.user_data.setdefault("reklama_segment", {})
+        if query.data.startswith("ad_seg_active_"):
+            segment["active_days"] = int(query.data.replace("ad_seg_active_", ""))
+        elif query.data.startswith("ad_seg_sample_"):
+            segment["sample_percent"] = int(query.data.replace("ad_seg_sample_", ""))
+        elif query.data == "ad_seg_clear":
+            segment.clear()
+        elif query.data == "ad_seg_joined":
+            context.user_data["waiting_ad_segment_joined"] = True
+            await query.message.edit_text(
+                "📅 Qo'shilgan sana oralig'ini yuboring:\n\n<code>2026-01-01 2026-01-31</code>", parse_mode='HTML'
             )
-            
-            failed_count = len(new_failed_ids)
-            not_sent = skipped_blocked + skipped_unreachable + failed_count
-            
-            if new_failed_ids:
-                save_last_ad_state(user_id, payload, new_failed_ids, state.get("buttons", []))
-                report_kb = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("♻️ Qayta yuborish", callback_data="ad_retry_failed"),
-                     InlineKeyboardButton("❌ Bekor qilish", callback_data="ad_cancel_retry")]
-                ])
-            else:
-                clear_last_ad_state(user_id)
-                report_kb = None
-            
-            result_text = (
-                "✅ <b>QAYTA YUBORISH HISOBOTI</b>\n\n"
-                "━━━━━━━━━━━━━━━━━━━━\n"
-                f"📊 Qayta yuborish ro'yxati: <b>{len(failed_ids)}</b>\n"
-                f"✅ Yuborildi: <b>{success_count}</b>\n"
-                f"🚫 Bloklangan (DB): <b>{skipped_blocked}</b>\n"
-                f"⏭ Yetib bormagan (o'tkazib yuborildi): <b>{skipped_unreachable}</b>\n"
-                f"❌ Yuborilmadi (xato): <b>{failed_count}</b>\n"
-                f"📌 Umumiy yuborilmadi: <b>{not_sent}</b>\n"
-                "━━━━━━━━━━━━━━━━━━━━\n\n"
-                f"📅 {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+            return
+        elif query.data == "ad_seg_film":
+            context.user_data["waiting_ad_segment_film"] = True
+            await query.message.edit_text("🎬 Film kodini yuboring:")
+            return
+
+        if query.data == "ad_seg_done":
+            view_text, view_markup = await _ad_approve_view(context)
+        else:
+            view_text, view_markup = await _ad_segment_view(context)
+        await query.message.edit_text(view_text, parse_mode='HTML', reply_markup=view_markup)
+
+    elif query.data.startswith(("ad_campaign_pause_", "ad_campaign_resume_", "ad_campaign_cancel_")):
+        if not has_permission(user_id, "AD_SEND"):
+            await query.answer("Sizda ruxsat yo'q!", show_alert=True)
+            return
+        action, campaign_id = query.data.rsplit("_", 1)
+        campaign_id = int(campaign_id)
+        campaign = await get_broadcast_campaign(campaign_id)
+        if not campaign:
+            await query.answer("Kampaniya topilmadi!", show_alert=True)
+            return
+        running_here = _campaign_controls.get(campaign_id) == "running"
+
+        if action == "ad_campaign_pause":
+            if not running_here:
+                await query.answer("Kampaniya hozir yuborilmayapti.", show_alert=True)
+                return
+            _campaign_controls[campaign_id] = "paused"
+            await query.answer("⏸ Joriy partiya tugagach pauza qilinadi.", show_alert=True)
+            await log_admin_action(user_id, "Reklama pauza qilindi", f"Kampaniya #{campaign_id}")
+
+        elif action == "ad_campaign_resume":
+            if campaign["status"] != "paused":
+                await query.answer("Kampaniya pauzada emas.", show_alert=True)
+                return
+            await set_broadcast_campaign_status(campaign_id, "running")
+            await query.message.edit_text(
+                f"⏳ <b>Reklama yuborilmoqda...</b>\n\n🆔 Kampaniya: <b>#{campaign_id}</b>\n"
+                "Yuborish to'xtagan joyidan davom etmoqda.",
+                parse_mode='HTML',
+                reply_markup=_campaign_control_markup(campaign_id)
             )
-            
-            await query.message.edit_text(result_text, parse_mode='HTML', reply_markup=report_kb)
-            log_admin_action(user_id, "Reklama qayta yuborildi", f"Yuborildi: {success_count}, Yuborilmadi: {not_sent}")
-    
+            start_broadcast_campaign(context.bot, campaign_id)
+            await log_admin_action(user_id, "Reklama davom ettirildi", f"Kampaniya #{campaign_id}")
+
+        else:
+            if running_here:
+                _campaign_controls[campaign_id] = "cancelled"
+                await query.answer("⛔️ Joriy partiya tugagach to'xtatiladi.", show_alert=True)
+            elif campaign["status"] in ("running", "paused"):
+                await set_broadcast_campaign_status(campaign_id, "cancelled")
+                campaign["status"] = "cancelled"
+                await query.message.edit_text(
+                    _format_campaign_report(campaign, "⛔️ <b>REKLAMA TO'XTATILDI</b>"), parse_mode='HTML'
+                )
+                await log_admin_action(user_id, "Reklama to'xtatildi", f"Kampaniya #{campaign_id}")
+            else:
+                await query.answer("Kampaniya allaqachon yakunlangan.", show_alert=True)
+
     elif query.data == "ad_cancel_retry":
-        clear_last_ad_state(user_id)
         await query.message.edit_text("🚫 Qayta yuborish bekor qilindi.", parse_mode='HTML')
 
     elif query.data == "reject_ad":
@@ -2894,13 +4830,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["reklama_mode"] = True
 
     elif query.data == "show_stats":
-        stats = get_statistics()
-        c.execute("SELECT COUNT(*) FROM films")
-        films_count = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM admins")
-        admins_count = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM blocked_users")
-        blocked_count = c.fetchone()[0]
+        stats = await get_statistics()
+        films_count = await get_films_count()
+        admins_count = len(_admin_ids)
+        blocked_count = len(_blocked_ids)
+
+        cache_total = _film_cache_stats["hits"] + _film_cache_stats["misses"]
+        cache_hit_rate = (_film_cache_stats["hits"] / cache_total * 100) if cache_total else 0
 
         growth = ""
         if stats['yesterday_joins'] > 0:
@@ -2918,7 +4854,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ━━━━━━━━━━━━━━━━━━━━
 👥 <b>Foydalanuvchilar:</b>
 ├ Jami: <b>{stats['total']}</b>
-├ Faol (24 soat): <b>{stats['active_users']}</b>
+├ Yetib boriladi: <b>{stats['total'] - stats['unreachable']}</b>
+├ Botni tark etgan: <b>{stats['unreachable']}</b>
+├ Faol (bugun): <b>{stats['active_users']}</b>
 └ Bloklangan: <b>{blocked_count}</b>
 
 📈 <b>Qo'shilish:</b>
@@ -2930,22 +4868,218 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ├ Filmlar: <b>{films_count}</b> ta
 └ Adminlar: <b>{admins_count}</b> ta
 
+⚡️ <b>Film keshi:</b>
+├ Hit: <b>{_film_cache_stats['hits']}</b>
+├ Miss: <b>{_film_cache_stats['misses']}</b>
+└ Samaradorlik: <b>{cache_hit_rate:.1f}%</b>
+
 ━━━━━━━━━━━━━━━━━━━━
 📅 {datetime.now().strftime("%d.%m.%Y %H:%M")}
 """
         keyboard = [[InlineKeyboardButton("⬅ Asosiy menyu", callback_data="back_main")]]
         await query.message.edit_text(stats_text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(keyboard))
 
-if __name__ == '__main__':
-    app = ApplicationBuilder().token(TOKEN).build()
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Different users are handled in parallel, one user's updates strictly one after another,
+    # so the context.user_data wizards see them in order. _slots bounds all in-flight updates;
+    # the base class gets a limit it never reaches, so its own semaphore never blocks.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._user_locks = {}  # user_id -> [lock, updates queued or running]
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Wait for the user's turn before taking a slot, so one user's burst can't hold them all
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large"}
+
+_http_server = None
+
+async def _route_http(application, method, path, headers, body):
+    # Returns (status, content_type, body)
+    if method == "GET" and path == "/":
+        return 200, "text/plain; charset=utf-8", "Bot is alive ✅".encode()
+    if method == "GET" and path == "/ping":
+        return 200, "text/plain; charset=utf-8", b"pong"
+    if method == "GET" and path == "/metrics" and METRICS_TOKEN:
+        auth = headers.get("authorization", "").encode("latin-1")
+        if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}".encode()):
+            return 403, "text/plain; charset=utf-8", b"forbidden"
+        return 200, "application/json", json.dumps(get_broadcast_metrics()).encode()
+    if method == "POST" and WEBHOOK_URL and path == WEBHOOK_PATH:
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET.encode()):
+            return 403, "text/plain; charset=utf-8", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            logging.warning(f"Webhook: noto'g'ri update: {e}")
+            return 400, "text/plain; charset=utf-8", b"bad update"
+        # Acknowledge right away; the Application processes the queue
+        await application.update_queue.put(update)
+        return 200, "text/plain; charset=utf-8", b""
+    return 404, "text/plain; charset=utf-8", b"not found"
+
+async def _handle_http(application, reader, writer):
+    # Minimal HTTP/1.1 with keep-alive, enough for Telegram's webhook and health checks
+    try:
+        while True:
+            request_line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE_TIMEOUT)
+            if not request_line:
+                break
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", "0"))
+            keep_alive = headers.get("connection", "").lower() != "close"
+            if length > HTTP_MAX_BODY:
+                status, content_type, body = 413, "text/plain; charset=utf-8", b"too large"
+                keep_alive = False
+            else:
+                body = await asyncio.wait_for(reader.readexactly(length), HTTP_KEEPALIVE_TIMEOUT) if length else b""
+                status, content_type, body = await _route_http(
+                    application, method, target.split("?", 1)[0], headers, body
+                )
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def start_http_server(application):
+    global _http_server
+    handler = functools.partial(_handle_http, application)
+    try:
+        _http_server = await asyncio.start_server(handler, "0.0.0.0", HTTP_PORT)
+        port = HTTP_PORT
+    except OSError as e:
+        logging.warning(f"Port {HTTP_PORT} band ({e}), 8080 port sinab ko'rilmoqda...")
+        try:
+            _http_server = await asyncio.start_server(handler, "0.0.0.0", 8080)
+            port = 8080
+        except OSError as e:
+            # Webhook updates arrive only through this server; in polling mode it is just health checks
+            if WEBHOOK_URL:
+                raise
+            logging.error(f"HTTP server ishga tushmadi ({e}), bot polling rejimida davom etadi")
+            return
+    logging.info(f"HTTP server {port} portda ishlayapti")
+
+async def stop_http_server():
+    global _http_server
+    if _http_server:
+        _http_server.close()
+        await _http_server.wait_closed()
+        _http_server = None
+
+async def run_webhook(application, stop=None):
+    # The run_polling lifecycle, with updates arriving through the HTTP server instead of getUpdates
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+    await application.initialize()
+    try:
+        await application.post_init(application)
+        await application.bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        await application.start()
+        logging.info(f"Webhook: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        await stop.wait()
+    finally:
+        # Stop taking updates before the queue is drained
+        await stop_http_server()
+        if application.running:
+            await application.stop()
+            await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+async def on_startup(application):
+    await start_http_server(application)
+    await resume_broadcast_campaigns(application.bot)
+    start_post_scheduler(application.bot)
+    start_activity_flusher()
+
+async def on_stop(application):
+    await stop_http_server()
+    await stop_background_tasks()
+
+async def on_shutdown(application):
+    flushed = await flush_user_activity()
+    logging.info(f"Shutdown: {flushed} ta user faolligi saqlandi")
+    shutdown_db()
+
+def build_application():
+    builder = (
+        ApplicationBuilder().token(TOKEN)
+        .base_url(TELEGRAM_BASE_URL)
+        .rate_limiter(send_rate_limiter)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
+    application = builder.build()
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(
         (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL |
          filters.AUDIO | filters.VOICE) & ~filters.COMMAND,
         handle_message
     ))
-    app.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    return application
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "--broadcast-shard":
+        asyncio.run(run_broadcast_shard(int(sys.argv[2]), int(sys.argv[3])))
+        shutdown_db()
+        sys.exit(0)
+
+    app = build_application()
 
     logging.info("Bot ishga tushdi ✅")
-    app.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
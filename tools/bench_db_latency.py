@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Event-loop latency while many updates hit the database, in a throwaway directory:
+#   python tools/bench_db_latency.py [--users 200] [--updates 20]
+# "before" calls the DB helpers synchronously on the loop (how handlers used sqlite3 before
+# the DB thread), "after" awaits them. A ticker measures how late the loop wakes it up.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TICK = 0.001
+WORDS = ["qasoskorlar", "muzlik", "sher", "shoh", "dengiz", "sirli", "orol", "robot", "ajdar", "panda"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] * 1000
+
+
+async def ticker(lags, stop):
+    while not stop.is_set():
+        expected = time.perf_counter() + TICK
+        await asyncio.sleep(TICK)
+        lags.append(max(0.0, time.perf_counter() - expected))
+
+
+async def handle_update(main, blocking, films, user_id, update_no):
+    # One simulated update: activity write, channel list and a film code lookup (bypassing the
+    # film cache); every 10th update is a text search, every 50th an admin statistics view
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    calls = [
+        (main._write_user_activity, ([(user_id, now, now)],)),
+        (main.get_all_channels, ()),
+        (main._load_film_entry, (f"b{random.randrange(films)}",)),
+    ]
+    if update_no % 10 == 0:
+        calls.append((main.search_films, (" ".join(random.sample(WORDS, 2)),)))
+    if update_no % 50 == 0:
+        calls.append((main._read_statistics, ()))
+    for func, args in calls:
+        if blocking:
+            func.sync(*args)
+        else:
+            await func(*args)
+    if blocking:
+        await asyncio.sleep(0)
+
+
+async def run(main, blocking, films, users, updates):
+    lags, update_times = [], []
+    stop = asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, stop))
+
+    async def user(user_id):
+        for update_no in range(updates):
+            started = time.perf_counter()
+            await handle_update(main, blocking, films, user_id, update_no)
+            update_times.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(1_000_000 + u) for u in range(users)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+    return {
+        "loop_p50": percentile(lags, 50), "loop_p99": percentile(lags, 99), "loop_max": max(lags) * 1000,
+        "update_p50": percentile(update_times, 50), "update_p99": percentile(update_times, 99),
+        "updates_per_s": users * updates / elapsed,
+    }
+
+
+def seed(main, films):
+    main.conn.execute("BEGIN")
+    for i in range(films):
+        caption = " ".join(random.choices(WORDS, k=4))
+        main.save_film.sync(f"b{i}", f"file{i}", "video", caption)
+    main.conn.execute("COMMIT")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DB event-loop latency benchmark")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=20)
+    parser.add_argument("--films", type=int, default=5000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:bench")
+    os.chdir(tempfile.mkdtemp())
+    import main as bot_main
+    logging.disable(logging.INFO)
+    random.seed(1)
+    seed(bot_main, args.films)
+
+    print(f"{args.users} users x {args.updates} updates, {args.films} films")
+    print(f"{'':8} {'loop p50':>9} {'loop p99':>9} {'loop max':>9} {'upd p50':>9} {'upd p99':>9} {'upd/s':>8}")
+    for name, blocking in (("before", True), ("after", False)):
+        r = asyncio.run(run(bot_main, blocking, args.films, args.users, args.updates))
+        print(f"{name:8} {r['loop_p50']:8.2f}ms {r['loop_p99']:8.2f}ms {r['loop_max']:8.2f}ms "
+              f"{r['update_p50']:8.2f}ms {r['update_p99']:8.2f}ms {r['updates_per_s']:8.0f}")
+    bot_main.shutdown_db()
+
+
+if __name__ == "__main__":
+    main()
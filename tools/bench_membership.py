@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+# is_member() response time as required channels are added, against a fake bot whose
+# get_chat_member takes --latency seconds (with jitter), in a throwaway directory:
+#   python tools/bench_membership.py [--latency 0.1] [--channels 8]
+# "before" is the old one-channel-after-another loop, "after" is is_member(force_refresh=True).
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeBot:
+    def __init__(self, latency, hung=()):
+        self.latency = latency
+        self.hung = set(hung)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await asyncio.sleep(60 if chat_id in self.hung else self.latency * random.uniform(0.8, 1.2))
+        return SimpleNamespace(status="member")
+
+    async def export_chat_invite_link(self, chat_id):
+        return f"https://t.me/+{chat_id[1:]}"
+
+
+async def is_member_sequential(main, user_id):
+    # The loop is_member() used before the checks were fanned out, without the invite-link healing
+    not_joined = []
+    for channel_username, channel_type, display_name, invite_link in await main.get_all_channels():
+        if channel_type != "Telegram":
+            continue
+        try:
+            member = await main.app.bot.get_chat_member(chat_id=channel_username, user_id=user_id)
+            if member.status not in ["member", "creator", "administrator"]:
+                not_joined.append((channel_username, display_name, invite_link))
+        except Exception as e:
+            logging.error(f"{channel_username}: {e}")
+    return not_joined
+
+
+async def measure(check, runs):
+    times = []
+    for run in range(runs):
+        started = time.perf_counter()
+        await check(5000 + run)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times) * 1000
+
+
+async def bench(main, latency, max_channels, runs):
+    main.app = SimpleNamespace(bot=FakeBot(latency))
+    print(f"get_chat_member latency {latency * 1000:.0f}ms, median of {runs} runs")
+    print(f"{'channels':>8} {'before':>10} {'after':>10}")
+    count = len(await main.get_all_channels())
+    while True:
+        before = await measure(lambda uid: is_member_sequential(main, uid), runs)
+        after = await measure(lambda uid: main.is_member(uid, force_refresh=True), runs)
+        print(f"{count:>8} {before:8.0f}ms {after:8.0f}ms")
+        if count >= max_channels:
+            break
+        count += 1
+        await main.add_channel(f"@bench_channel_{count}", "Telegram", 0, f"Kanal {count}", f"https://t.me/+c{count}")
+
+    # One channel never answers: the old loop waits on it, the new one gives up after the timeout
+    main.app.bot.hung.add((await main.get_all_channels())[-1][0])
+    started = time.perf_counter()
+    result = await main.is_member(1, force_refresh=True)
+    print(f"one hung channel: after {(time.perf_counter() - started) * 1000:.0f}ms "
+          f"(MEMBERSHIP_CHECK_TIMEOUT={main.MEMBERSHIP_CHECK_TIMEOUT:g}s, "
+          f"policy={main.MEMBERSHIP_TIMEOUT_POLICY}, not joined: {len(result)}); before waits as long as the channel does")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Membership check benchmark")
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:bench")
+    os.environ.setdefault("MEMBERSHIP_CHECK_TIMEOUT", "1")
+    os.chdir(tempfile.mkdtemp())
+    import main as bot_main
+    logging.disable(logging.WARNING)
+    random.seed(1)
+    asyncio.run(bench(bot_main, args.latency, args.channels, args.runs))
+    bot_main.shutdown_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Request size and client CPU per broadcast send for the three modes (send, copy, forward),
+# against tools/fake_telegram.py, in a throwaway directory:
+#   python tools/bench_payload.py [--sends 2000]
+# The fake Bot API runs on its own thread and event loop, so time.thread_time() on the main
+# thread counts only the bot side: building the request, HTTP and parsing the reply.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from telegram.ext import ExtBot
+
+from fake_telegram import FakeTelegram
+
+CAPTION = ("🎬 <b>Yangi multfilm</b>\n\n" + "Sevimli qahramonlar yangi sarguzashtlarda. " * 14)[:600]
+BUTTONS = [[{"text": "📺 Kanal", "url": "https://t.me/multklar_olami"}],
+           [{"text": "🤖 Bot", "url": "https://t.me/fakebot?start=ad"}]]
+CONCURRENCY = 25
+
+
+def start_fake():
+    # Own loop on a daemon thread, so its CPU time stays off the measured thread
+    loop = asyncio.new_event_loop()
+    fake = FakeTelegram()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(fake.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return fake
+
+
+async def bench_mode(main, fake, mode, sends):
+    payload = {"type": "video", "file_id": "BAACAgIAAxkBAAI" + "x" * 60, "caption": CAPTION, "mode": mode,
+               "source_chat_id": 5663190258, "source_message_id": 1234}
+    bot = ExtBot("1:bench", base_url=fake.base_url)
+    async with bot:
+        send = main._make_broadcast_sender(bot, payload, main._build_markup_from_serialized(BUTTONS))
+        sem = asyncio.Semaphore(CONCURRENCY)
+
+        async def send_one(uid):
+            async with sem:
+                await send(chat_id=uid)
+
+        await asyncio.gather(*(send_one(uid) for uid in range(1, 51)))  # warm-up
+        seen = len(fake.body_sizes)
+        cpu, wall = time.thread_time(), time.perf_counter()
+        await asyncio.gather(*(send_one(uid) for uid in range(100, 100 + sends)))
+        cpu, wall = time.thread_time() - cpu, time.perf_counter() - wall
+    sizes = [size for method, size in fake.body_sizes[seen:]]
+    method = fake.body_sizes[-1][0]
+    return method, statistics.mean(sizes), cpu / sends * 1e6, sends / wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast payload size and CPU benchmark")
+    parser.add_argument("--sends", type=int, default=2000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:bench")
+    os.chdir(tempfile.mkdtemp())
+    import main as bot_main
+    logging.disable(logging.ERROR)
+    fake = start_fake()
+
+    print(f"{args.sends} sends of a video ad with a {len(CAPTION)}-character caption and 2 URL buttons")
+    print(f"{'mode':8} {'method':14} {'bytes/request':>14} {'CPU/send':>10} {'sends/s':>8}")
+    for mode in ("send", "copy", "forward"):
+        method, size, cpu_us, rate = asyncio.run(bench_mode(bot_main, fake, mode, args.sends))
+        print(f"{mode:8} {method:14} {size:14.0f} {cpu_us:8.0f}us {rate:8.0f}")
+    bot_main.shutdown_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Drives main.py in webhook mode against tools/fake_telegram.py, in a throwaway directory:
+#   python tools/check_webhook.py
+# Checks that updates without the secret token are refused, that a real update gets a reply
+# and that /metrics needs METRICS_TOKEN.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from fake_telegram import FakeTelegram
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def http(port, method, path, headers=None, body=b""):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    head = "".join(f"{k}: {v}\r\n" for k, v in (headers or {}).items())
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: x\r\nConnection: close\r\n"
+        f"Content-Length: {len(body)}\r\n{head}\r\n".encode() + body
+    )
+    await writer.drain()
+    reply = await reader.read()
+    writer.close()
+    return int(reply.split(b" ", 2)[1])
+
+
+def start_update(update_id, user_id):
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        },
+    }).encode()
+
+
+async def main():
+    fake = await FakeTelegram().start()
+    port = free_port()
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "1:check",
+        "TELEGRAM_BASE_URL": fake.base_url,
+        "WEBHOOK_URL": "https://example.invalid",
+        "PORT": str(port),
+        "METRICS_TOKEN": "metrics-check",
+    })
+    os.environ.pop("WEBHOOK_SECRET", None)
+    os.chdir(tempfile.mkdtemp())
+    import main as bot_main
+
+    application = bot_main.build_application()
+    bot_main.app = application
+    stop = asyncio.Event()
+    runner = asyncio.create_task(bot_main.run_webhook(application, stop))
+    for _ in range(100):
+        if fake.sent("setWebhook") and bot_main._http_server:
+            break
+        await asyncio.sleep(0.05)
+
+    secret = fake.sent("setWebhook")[0][2].get("secret_token")
+    assert secret and secret == bot_main.WEBHOOK_SECRET, "setWebhook got no secret"
+
+    path = bot_main.WEBHOOK_PATH
+    assert await http(port, "POST", path, body=start_update(1, 1001)) == 403
+    assert await http(port, "POST", path, {"X-Telegram-Bot-Api-Secret-Token": "wrong"}, start_update(2, 1002)) == 403
+    assert await http(port, "POST", path, {"X-Telegram-Bot-Api-Secret-Token": secret}, start_update(3, 1003)) == 200
+
+    for _ in range(100):
+        if fake.sent("sendMessage"):
+            break
+        await asyncio.sleep(0.05)
+    chats = {params.get("chat_id") for _, _, params in fake.sent("sendMessage")}
+    assert chats == {"1003"}, f"kutilmagan javoblar: {chats}"
+
+    assert await http(port, "GET", "/metrics") == 403
+    assert await http(port, "GET", "/metrics", {"Authorization": "Bearer metrics-check"}) == 200
+
+    stop.set()
+    await runner
+    await fake.stop()
+    print("webhook: OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
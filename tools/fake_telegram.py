@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import parse_qsl
+
+# Local stand-in for the Telegram Bot API. Point the bot at it with
+#   TELEGRAM_BASE_URL=http://127.0.0.1:<port>/bot
+# Every call is recorded in FakeTelegram.calls as (token, method, params) and its body size in
+# FakeTelegram.body_sizes as (method, bytes). latency delays each reply, and
+# fail(token, method, params) may return (error_code, description) to fail a call.
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, fail=None, bot_username="fakebot"):
+        self.latency = latency
+        self.fail = fail
+        self.bot_username = bot_username
+        self.calls = []
+        self.body_sizes = []
+        self.server = None
+        self.port = None
+        self._message_id = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self, port=0):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def sent(self, method=None):
+        return [(token, name, params) for token, name, params in self.calls if method is None or name == method]
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": self.bot_username}
+        if method == "getChatMember":
+            user = {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "u"}
+            return {"status": "member", "user": user}
+        if method in ("setWebhook", "deleteWebhook", "answerCallbackQuery", "setMyCommands"):
+            return True
+        if method == "exportChatInviteLink":
+            return "https://t.me/+fake"
+        if method == "copyMessage":
+            self._message_id += 1
+            return {"message_id": self._message_id}
+        self._message_id += 1
+        chat_id = params.get("chat_id", "0")
+        chat = {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 0, "type": "private"}
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": chat, "text": params.get("text", "")}
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                body = await reader.readexactly(length) if length else b""
+                # /bot<token>/<method>
+                _, _, path = target.partition("/bot")
+                token, _, method = path.partition("/")
+                if "json" in headers.get("content-type", ""):
+                    params = {k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body or b"{}").items()}
+                elif "multipart" in headers.get("content-type", ""):
+                    params = {}
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                self.calls.append((token, method, params))
+                self.body_sizes.append((method, length))
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                error = self.fail(token, method, params) if self.fail else None
+                if error:
+                    code, description = error
+                    reply = {"ok": False, "error_code": code, "description": description}
+                    if code == 429:
+                        reply["parameters"] = {"retry_after": 1}
+                else:
+                    code, reply = 200, {"ok": True, "result": self._result(method, params)}
+                payload = json.dumps(reply).encode()
+                writer.write(
+                    f"HTTP/1.1 {code} X\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _serve(port):
+    fake = await FakeTelegram().start(port)
+    print(f"Fake Telegram: {fake.base_url}")
+    seen = 0
+    while True:
+        await asyncio.sleep(0.5)
+        for token, method, params in fake.calls[seen:]:
+            print(f"{method} {json.dumps(params, ensure_ascii=False)[:200]}")
+        seen = len(fake.calls)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    asyncio.run(_serve(parser.parse_args().port))